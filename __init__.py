@@ -1,24 +1,44 @@
 #The COPYRIGHT file at the top level of this repository contains the full
 #copyright notices and license terms.
 from trytond.pool import Pool
+from . import bom
 from . import configuration
 from . import product
 from . import production
+from . import route
 from . import sale
+from . import stock
+from . import work
 
 
 def register():
     Pool.register(
         configuration.Configuration,
+        bom.BOM,
+        bom.BOMInput,
+        bom.BOMOutput,
         product.Template,
         product.Product,
+        product.ProductBom,
+        product.Uom,
         production.Production,
         production.ChangeQuantityStart,
+        production.ChangeQuantitiesStart,
+        production.ChangeQuantitiesLine,
         sale.Sale,
         sale.SaleLine,
+        sale.SaleLineProduction,
+        sale.SaleQueueTask,
+        sale.MaterialRequirementsStart,
+        sale.MaterialRequirement,
+        stock.Location,
         module='sale_supply_production', type_='model')
+    Pool.register(
+        sale.MaterialRequirements,
+        module='sale_supply_production', type_='wizard')
     Pool.register(
         production.ChangeQuantity,
+        production.ChangeQuantities,
         depends=['sale_change_quantity'],
         module='sale_supply_production', type_='wizard')
     Pool.register(
@@ -32,5 +52,12 @@ def register():
     Pool.register(
         configuration.ConfigurationProductionWork,
         configuration.ConfigurationDefaultWorkCenter,
+        work.Production,
+        work.WorkCenter,
         depends=['production_work'],
         module='sale_supply_production', type_='model')
+    Pool.register(
+        route.Route,
+        route.RouteOperation,
+        depends=['production_operation'],
+        module='sale_supply_production', type_='model')
@@ -0,0 +1,36 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class BOM(metaclass=PoolMeta):
+    __name__ = 'production.bom'
+
+    @classmethod
+    def on_modification(cls, mode, boms, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, boms, field_names=field_names)
+        Production._explode_bom_cache.clear()
+
+
+class BOMInput(metaclass=PoolMeta):
+    __name__ = 'production.bom.input'
+
+    @classmethod
+    def on_modification(cls, mode, inputs, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, inputs, field_names=field_names)
+        Production._explode_bom_cache.clear()
+
+
+class BOMOutput(metaclass=PoolMeta):
+    __name__ = 'production.bom.output'
+
+    @classmethod
+    def on_modification(cls, mode, outputs, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, outputs, field_names=field_names)
+        Production._explode_bom_cache.clear()
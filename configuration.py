@@ -1,8 +1,10 @@
+from trytond.cache import Cache
 from trytond.model import fields, ModelSQL
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
 
 
 class Configuration(metaclass=PoolMeta):
@@ -10,6 +12,74 @@ class Configuration(metaclass=PoolMeta):
     sale_supply_production_default = fields.Boolean(
         'Sale Line Supply Production',
         help='Default Supply Production value for Sale Lines')
+    sale_supply_production_queue = fields.Boolean(
+        'Queue Supply Productions',
+        help='Create the productions of the sales in queued tasks')
+    sale_supply_production_queue_size = fields.Integer(
+        'Supply Productions Queue Size',
+        states={
+            'invisible': ~Eval('sale_supply_production_queue'),
+            },
+        help='The number of sale lines for each queued task')
+    sale_supply_production_consolidate = fields.Boolean(
+        'Consolidate Supply Productions',
+        help='Supply the sale lines of the same product, BOM, route and '
+        'warehouse with a shared production')
+    sale_supply_production_consolidate_days = fields.Integer(
+        'Supply Productions Consolidation Days',
+        states={
+            'invisible': ~Eval('sale_supply_production_consolidate'),
+            },
+        help='The number of days of planned date grouped in a shared '
+        'production')
+    sale_supply_production_components = fields.Boolean(
+        'Supply Components with Productions',
+        help='Create also the productions of the producible components of '
+        'the BOM of the sold products')
+    sale_supply_production_reuse = fields.Boolean(
+        'Reuse Draft Productions',
+        help='Supply the sale lines with the quantity not allocated of the '
+        'draft productions without origin of the same product, BOM and '
+        'warehouse before creating new productions')
+    sale_supply_production_reuse_days = fields.Integer(
+        'Draft Productions Reuse Days',
+        states={
+            'invisible': ~Eval('sale_supply_production_reuse'),
+            },
+        help='The number of days before the planned date of the sale line in '
+        'which the draft productions are reused')
+    _supply_production_cache = Cache(
+        'sale.configuration.supply_production', context=False)
+
+    @classmethod
+    def get_supply_production_values(cls, company=None):
+        """Return the values used to supply sales with productions
+
+        The values are cached by company until the configuration changes."""
+        if company is None:
+            company = Transaction().context.get('company')
+        values = cls._supply_production_cache.get(company)
+        if values is None:
+            values = cls(1)._get_supply_production_values(company)
+            cls._supply_production_cache.set(company, values)
+        return values
+
+    def _get_supply_production_values(self, company):
+        return {
+            'supply_production_default': self.sale_supply_production_default,
+            'queue': self.sale_supply_production_queue,
+            'queue_size': self.sale_supply_production_queue_size,
+            'consolidate': self.sale_supply_production_consolidate,
+            'consolidate_days': self.sale_supply_production_consolidate_days,
+            'components': self.sale_supply_production_components,
+            'reuse': self.sale_supply_production_reuse,
+            'reuse_days': self.sale_supply_production_reuse_days,
+            }
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        cls._supply_production_cache.clear()
 
 
 class ConfigurationProductionWork(CompanyMultiValueMixin, metaclass=PoolMeta):
@@ -21,7 +91,16 @@ class ConfigurationProductionWork(CompanyMultiValueMixin, metaclass=PoolMeta):
                 ('company', 'in',
                     [Eval('context', {}).get('company', -1), None]),
                 ],
-            help='Default Work Center for the Productions created from Sales'))
+            help='Default Work Center for the Productions created from Sales.\n'
+            'When it has children, the child with the least load in the '
+            'planned dates of the production is used.'))
+
+    def _get_supply_production_values(self, company):
+        values = super()._get_supply_production_values(company)
+        work_center = self.get_multivalue(
+            'default_work_center', company=company)
+        values['default_work_center'] = work_center.id if work_center else None
+        return values
 
 
 class ConfigurationDefaultWorkCenter(ModelSQL, CompanyValueMixin):
@@ -33,4 +112,13 @@ class ConfigurationDefaultWorkCenter(ModelSQL, CompanyValueMixin):
             ('company', 'in',
                 [Eval('context', {}).get('company', -1), None]),
             ],
-        help='Default Work Center for the Productions created from Sales')
+        help='Default Work Center for the Productions created from Sales.\n'
+            'When it has children, the child with the least load in the '
+            'planned dates of the production is used.')
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._supply_production_cache.clear()
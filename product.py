@@ -1,6 +1,8 @@
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 
 
@@ -34,6 +36,78 @@ class Template(metaclass=PoolMeta):
 
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
+    _boms_cache = Cache('product.product.boms', context=False)
 
     def get_bom(self, pattern=None):
-        return self.boms and self.boms[0] or None
+        "Return the first product BOM matching the pattern from the cache"
+        product = self.__class__(self.id, boms=self.get_boms([self])[self.id])
+        return super(Product, product).get_bom(pattern)
+
+    @classmethod
+    def get_boms(cls, products):
+        """Return for each product its product BOMs in order
+
+        The ids of the product BOMs of all the products not yet cached are read
+        with a single query."""
+        pool = Pool()
+        ProductBom = pool.get('product.product-production.bom')
+
+        product2bom_ids = {}
+        missing = []
+        for product in products:
+            bom_ids = cls._boms_cache.get(product.id)
+            if bom_ids is None:
+                missing.append(product.id)
+            else:
+                product2bom_ids[product.id] = bom_ids
+        missing = sorted(set(missing))
+        if missing:
+            for product_id in missing:
+                product2bom_ids[product_id] = []
+            for sub_ids in grouped_slice(missing):
+                for product_bom in ProductBom.search([
+                            ('product', 'in', list(sub_ids)),
+                            ]):
+                    product2bom_ids[product_bom.product.id].append(
+                        product_bom.id)
+            for product_id in missing:
+                cls._boms_cache.set(product_id, product2bom_ids[product_id])
+        bom_ids = {i for ids in product2bom_ids.values() for i in ids}
+        id2bom = {b.id: b for b in ProductBom.browse(sorted(bom_ids))}
+        return {
+            p: [id2bom[i] for i in ids] for p, ids in product2bom_ids.items()}
+
+
+class ProductBom(metaclass=PoolMeta):
+    __name__ = 'product.product-production.bom'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super().on_modification(mode, records, field_names=field_names)
+        Product._boms_cache.clear()
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+    _conversion_factor_cache = Cache(
+        'product.uom.conversion_factor', context=False)
+
+    @classmethod
+    def get_conversion_factor(cls, from_uom, to_uom):
+        "Return the factor to convert a quantity from_uom into to_uom"
+        key = (from_uom.id, to_uom.id)
+        factor = cls._conversion_factor_cache.get(key)
+        if factor is None:
+            factor = cls.compute_qty(from_uom, 1, to_uom, round=False)
+            cls._conversion_factor_cache.set(key, factor)
+        return factor
+
+    @classmethod
+    def on_modification(cls, mode, uoms, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, uoms, field_names=field_names)
+        Production._explode_bom_cache.clear()
+        cls._conversion_factor_cache.clear()
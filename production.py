@@ -1,42 +1,640 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import io
+from decimal import Decimal
+from collections import defaultdict
+from contextlib import contextmanager
 from functools import wraps
-from trytond.model import ModelView, fields
+from weakref import WeakKeyDictionary
+
+from sql import Null
+from sql.conditionals import Case
+
+from trytond.cache import Cache
+from trytond.modules.production.bom import (
+    BOM as StandardBOM, BOMInput as StandardBOMInput,
+    BOMOutput as StandardBOMOutput)
+from trytond.model import Index, Model, ModelView, Workflow, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
-from trytond.transaction import Transaction, without_check_access
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.wizard import Button, StateTransition, StateView, Wizard
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 
+from .tools import measure
+
+# The ids of the sales to process of the transactions inside defer_process_sale
+_deferred_sale_ids = WeakKeyDictionary()
+
+
+def get_sale_ids(productions):
+    "Return the ids of the sales of the productions"
+    pool = Pool()
+    Production = pool.get('production')
+    SaleLine = pool.get('sale.line')
+    Share = pool.get('sale.line-production')
+    production = Production.__table__()
+    sale_line = SaleLine.__table__()
+    share = Share.__table__()
+    cursor = Transaction().connection.cursor()
+
+    sale_ids = set()
+    for sub_productions in grouped_slice(productions):
+        production_ids = [p.id for p in sub_productions]
+        cursor.execute(*production.select(production.sale,
+                where=reduce_ids(production.id, production_ids)
+                & (production.sale != Null),
+                group_by=production.sale))
+        sale_ids.update(s for s, in cursor)
+        cursor.execute(*share
+            .join(sale_line, condition=share.sale_line == sale_line.id)
+            .select(sale_line.sale,
+                where=reduce_ids(share.production, production_ids),
+                group_by=sale_line.sale))
+        sale_ids.update(s for s, in cursor)
+    return sorted(sale_ids)
+
+
 def process_sale():
     def _process_sale(func):
         @wraps(func)
         def wrapper(cls, productions):
             pool = Pool()
             Sale = pool.get('sale.sale')
-            SaleLine = Pool().get('sale.line')
-            transaction = Transaction()
-            context = transaction.context
-            with without_check_access():
-                sales = list(set([p.origin.sale for p in productions
-                            if p.origin and isinstance(p.origin, SaleLine)]))
-            func(cls, productions)
-            if sales:
-                with transaction.set_context(
-                        queue_batch=context.get('queue_batch', True)):
-                    Sale.__queue__.process(sales)
+            sale_ids = get_sale_ids(productions)
+            result = func(cls, productions)
+            if sale_ids:
+                deferred = _deferred_sale_ids.get(Transaction())
+                if deferred is not None:
+                    deferred.update(sale_ids)
+                else:
+                    Sale.queue_process(sale_ids)
+            return result
         return wrapper
     return _process_sale
 
 
+@contextmanager
+def defer_process_sale():
+    """Queue once, when leaving the context, the process of the sales of the
+    productions modified inside it"""
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    transaction = Transaction()
+    if transaction in _deferred_sale_ids:
+        yield
+        return
+    sale_ids = _deferred_sale_ids[transaction] = set()
+    try:
+        yield
+    finally:
+        del _deferred_sale_ids[transaction]
+    if sale_ids:
+        Sale.queue_process(sorted(sale_ids))
+
+
 class Production(metaclass=PoolMeta):
     __name__ = 'production'
+    _explode_bom_cache = Cache('production.explode_bom', context=False)
+    _route_operations_cache = Cache('production.route_operations')
+    sale_line = fields.Many2One('sale.line', "Sale Line", readonly=True)
+    sale = fields.Many2One('sale.sale', "Sale", readonly=True)
+    sale_line_shares = fields.One2Many(
+        'sale.line-production', 'production', "Sale Line Shares",
+        readonly=True,
+        help="The quantities of the sale lines supplied by the production "
+        "when it is shared.")
+    sale_shared = fields.Boolean(
+        "Shared by Sales", readonly=True,
+        help="If checked, the production was created to supply the sale "
+        "lines it is shared with.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.sale_line, Index.Range())),
+                Index(t, (t.sale, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_sale_line = not table_h.column_exist('sale_line')
+
+        super().__register__(module_name)
+
+        # Migration from 7.8: fill sale_line and sale from origin
+        if fill_sale_line:
+            cls._fill_sale_line_from_origin()
+
+    @classmethod
+    def _fill_sale_line_from_origin(cls):
+        """Fill the sale line and the sale of the productions from their origin
+
+        The origins are parsed in Python so the malformed ones are skipped and
+        the productions are updated by slices."""
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        table = cls.__table__()
+        sale_line = SaleLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(table.id, table.origin,
+                where=table.origin.like('sale.line,%')))
+        production2line = {}
+        for production_id, origin in cursor.fetchall():
+            try:
+                production2line[production_id] = int(origin.split(',', 1)[1])
+            except ValueError:
+                continue
+
+        line2sale = {}
+        for sub_ids in grouped_slice(sorted(set(production2line.values()))):
+            cursor.execute(*sale_line.select(sale_line.id, sale_line.sale,
+                    where=reduce_ids(sale_line.id, list(sub_ids))))
+            line2sale.update(cursor)
+
+        production_ids = sorted(
+            p for p, l in production2line.items() if l in line2sale)
+        for sub_ids in grouped_slice(production_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                    [table.sale_line, table.sale],
+                    [Case(*((table.id == i, production2line[i])
+                                for i in sub_ids)),
+                        Case(*((table.id == i, line2sale[production2line[i]])
+                                for i in sub_ids))],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @staticmethod
+    def default_sale_shared():
+        return False
 
     @classmethod
     def _get_origin(cls):
         return super()._get_origin() | {'sale.line'}
 
+    @classmethod
+    def preprocess_values(cls, mode, values):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        values = super().preprocess_values(mode, values)
+        if 'origin' in values and 'sale_line' not in values:
+            origin = values['origin']
+            if isinstance(origin, str):
+                origin = origin.split(',')
+            line = None
+            if origin and origin[0] == 'sale.line' and int(origin[1]) >= 0:
+                line = SaleLine(int(origin[1]))
+            values['sale_line'] = line.id if line else None
+            values['sale'] = line.sale.id if line else None
+        return values
+
+    @fields.depends('type', 'bom', 'product', 'unit', 'quantity',
+        methods=['_move', '_get_cached_explode_bom_template'])
+    def explode_bom(self):
+        """Explode the BOM like the standard method but with the quantities of
+        the cached template
+
+        The standard method is used when the factor, the quantities or the
+        moves of the BOM lines are customized."""
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        if (not (self.bom and self.product and self.unit)
+                or self._is_explode_bom_customized()):
+            return super().explode_bom()
+
+        factor_type = 'inputs' if self.type == 'disassembly' else 'outputs'
+        template = self._get_cached_explode_bom_template(factor_type)
+        if template is None:
+            return super().explode_bom()
+
+        moves = self._get_explode_bom_moves(template, self.quantity or 0)
+        for name, type_ in [('inputs', 'input'), ('outputs', 'output')]:
+            setattr(self, name, [
+                    self._move(type_, Product(p), Uom(u), q)
+                    for p, u, q in moves[name]])
+
+    @classmethod
+    def _is_explode_bom_customized(cls):
+        "Return if the methods used by the standard explode_bom are overridden"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        BOMInput = pool.get('production.bom.input')
+        BOMOutput = pool.get('production.bom.output')
+        if BOM.compute_factor is not StandardBOM.compute_factor:
+            return True
+        for Line, StandardLine in [
+                (BOMInput, StandardBOMInput),
+                (BOMOutput, StandardBOMOutput),
+                ]:
+            for name in [
+                    'compute_quantity', 'lines_for_quantity', 'prepare_move']:
+                if (getattr(Line, name, None)
+                        is not getattr(StandardLine, name, None)):
+                    return True
+        return False
+
+    @staticmethod
+    def _get_explode_bom_moves(template, quantity):
+        """Return the product, unit and quantity of the moves of the template
+        for the quantity to produce
+
+        The quantities are rounded like compute_quantity does, up for the
+        inputs and down for the outputs."""
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        factor = quantity / template['total']
+        moves = {}
+        for name, round_ in [('inputs', 'ceil'), ('outputs', 'floor')]:
+            moves[name] = []
+            for (product_id, unit_id, line_quantity,
+                    phantom_total, phantom_lines) in template[name]:
+                line_quantity = getattr(Uom(unit_id), round_)(
+                    line_quantity * factor)
+                if phantom_total is None:
+                    moves[name].append((product_id, unit_id, line_quantity))
+                    continue
+                phantom_factor = line_quantity / phantom_total
+                for product_id, unit_id, phantom_quantity in phantom_lines:
+                    moves[name].append((product_id, unit_id,
+                            getattr(Uom(unit_id), round_)(
+                                phantom_quantity * phantom_factor)))
+        return moves
+
+    @fields.depends('bom', 'product', 'unit',
+        methods=['_get_explode_bom_template'])
+    def _get_cached_explode_bom_template(self, type_):
+        key = (self.bom.id, self.product.id, self.unit.id, type_)
+        template = self._explode_bom_cache.get(key)
+        if template is None:
+            template = self._get_explode_bom_template(type_)
+            if template is not None:
+                self._explode_bom_cache.set(key, template)
+        return template
+
+    @classmethod
+    def load_lead_times(cls, products):
+        """Load the production lead times of the products with one query
+
+        The lead times are set on the product instances so compute_lead_time
+        does not read them for each production."""
+        pool = Pool()
+        LeadTime = pool.get('production.lead_time')
+
+        products = [p for p in products if p and p.id is not None and p.id >= 0]
+        product2lead_times = defaultdict(list)
+        for sub_ids in grouped_slice(sorted({p.id for p in products})):
+            for lead_time in LeadTime.search([
+                        ('product', 'in', list(sub_ids)),
+                        ]):
+                product2lead_times[lead_time.product.id].append(lead_time)
+        for product in products:
+            product.production_lead_times = product2lead_times[product.id]
+
+    @classmethod
+    def set_planned_start_dates(cls, productions):
+        "Set the planned start date of the productions at once"
+        cls.load_lead_times([p.product for p in productions if p.product])
+        for production in productions:
+            production.set_planned_start_date()
+
+    def get_input_coefficients(self):
+        """Return the quantity of each input product for one unit produced
+
+        The quantities are expressed in the default unit of the products and
+        are not rounded. None is returned when the BOM can not be exploded."""
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        if not (self.bom and self.product and self.unit):
+            return
+        template = self._get_cached_explode_bom_template('outputs')
+        if template is None:
+            return
+        coefficients = defaultdict(float)
+        for (product_id, unit_id, quantity,
+                phantom_total, phantom_lines) in template['inputs']:
+            quantity /= template['total']
+            if phantom_total is None:
+                lines = [(product_id, unit_id, quantity)]
+            else:
+                lines = [(p, u, q * quantity / phantom_total)
+                    for p, u, q in phantom_lines]
+            for product_id, unit_id, quantity in lines:
+                product = Product(product_id)
+                coefficients[product_id] += Uom.compute_qty(
+                    Uom(unit_id), quantity, product.default_uom, round=False)
+        return dict(coefficients)
+
+    @fields.depends('bom', 'product', 'unit')
+    def _get_explode_bom_template(self, type_):
+        """Return the BOM lines to explode for the product and unit
+
+        The quantities are not scaled so the template can be cached for any
+        production quantity. None is returned when it can not be computed or
+        when a phantom BOM contains another phantom BOM."""
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        total = 0
+        for line in getattr(self.bom, type_):
+            if line.product == self.product:
+                total += Uom.compute_qty(
+                    line.unit, line.quantity, self.unit, round=False)
+        if not total:
+            return
+        template = {'total': total}
+        for name in ['inputs', 'outputs']:
+            lines = []
+            for line in getattr(self.bom, name):
+                phantom_total, phantom_lines = None, []
+                if line.phantom_bom:
+                    phantom_total = Uom.compute_qty(
+                        line.phantom_bom.phantom_unit,
+                        line.phantom_bom.phantom_quantity, line.unit,
+                        round=False)
+                    if (not phantom_total
+                            or any(l.phantom_bom for l in line._phantom_lines)):
+                        return
+                    phantom_lines = [
+                        (l.product.id, l.unit.id, l.quantity)
+                        for l in line._phantom_lines]
+                lines.append((
+                        line.product.id if line.product else None,
+                        line.unit.id, line.quantity,
+                        phantom_total, phantom_lines))
+            template[name] = lines
+        return template
+
+    def explode_supply(self):
+        "Explode the BOM and the route of the production"
+        if getattr(self, 'bom', None):
+            self.inputs = []
+            self.outputs = []
+            # on_change_bom explodes the BOM
+            with measure('production.explode_bom', records=1):
+                self.on_change_bom()
+
+        if getattr(self, 'route', None):
+            with measure('production.on_change_route', records=1):
+                self.explode_route()
+
+    def explode_route(self):
+        """Set the operations of the route for the quantity
+
+        The values of the operations are cached by route, company and context
+        for the quantity they are computed and scaled to the quantity of the
+        next productions sharing the route."""
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        self.operations = []
+        key = self._get_route_operations_key()
+        cached = self._route_operations_cache.get(key)
+        if cached is None:
+            self.on_change_route()
+            if self.quantity:
+                self._route_operations_cache.set(key, (self.quantity, [
+                            self._get_route_operation_values(o)
+                            for o in self.operations or []]))
+        else:
+            quantity, template = cached
+            factor = (self.quantity or 0) / quantity
+            self.operations = [
+                Operation(**self._scale_route_operation_values(v, factor))
+                for v in template]
+
+    def _get_route_operations_key(self):
+        company = getattr(self, 'company', None)
+        unit = getattr(self, 'unit', None)
+        return (self.route.id,
+            company.id if company else None,
+            unit.id if unit else None)
+
+    def _get_route_operation_values(self, operation):
+        "Return the values to create again the operation of the route"
+        reverse = self._fields['operations'].field
+        return {
+            n: v for n, v in operation._save_values().items()
+            if n != reverse
+            and operation._fields[n]._type not in {'one2many', 'many2many'}}
+
+    @classmethod
+    def _get_route_operation_scaled_fields(cls):
+        "Return the names of the operation fields proportional to the quantity"
+        return {'quantity', 'planned_quantity', 'time', 'planned_time'}
+
+    def _scale_route_operation_values(self, values, factor):
+        pool = Pool()
+        Operation = pool.get('production.operation')
+        values = values.copy()
+        for name in self._get_route_operation_scaled_fields():
+            if values.get(name) is None or name not in Operation._fields:
+                continue
+            if Operation._fields[name]._type == 'numeric':
+                values[name] *= Decimal(str(factor))
+            else:
+                values[name] *= factor
+        return values
+
+    def set_quantity(self, quantity):
+        """Change the quantity of the production and of its moves
+
+        The moves of a saved production are rescaled unless its BOM or route
+        changed, otherwise they are exploded again."""
+        if (self.id is not None and self.id >= 0
+                and self.quantity
+                and not self.is_supply_changed()):
+            self.rescale(quantity)
+            return
+        self.quantity = quantity
+        if getattr(self, 'route', None):
+            self.explode_route()
+
+        if self.bom:
+            self.inputs = []
+            self.outputs = []
+            self.explode_bom()
+
+    @classmethod
+    def _get_consolidation_fields(cls):
+        "Return the fields that productions must share to be consolidated"
+        names = ['company', 'warehouse', 'location', 'product', 'bom',
+            'route', 'routing', 'process', 'cost_plan', 'work_center',
+            'quality_template']
+        return [n for n in names if n in cls._fields]
+
+    def get_consolidation_key(self, days):
+        "Return the key to group the productions sharing the same supply"
+        key = []
+        for name in self._get_consolidation_fields():
+            value = getattr(self, name, None)
+            if isinstance(value, Model):
+                value = value.id
+            key.append((name, value))
+        date = self.planned_date
+        key.append(('planned_date', date.toordinal() // days if date else None))
+        return tuple(key)
+
+    @classmethod
+    def get_consolidated_production(cls, key, days):
+        """Return the draft shared production for the key or None
+
+        The production may have a child of the work center of the key."""
+        domain = [
+            ('state', '=', 'draft'),
+            ('sale_shared', '=', True),
+            ]
+        for name, value in key:
+            if name == 'planned_date':
+                if value is None:
+                    domain.append(('planned_date', '=', None))
+                else:
+                    start = datetime.date.fromordinal(value * days)
+                    domain.append(('planned_date', '>=', start))
+                    domain.append(('planned_date', '<',
+                            start + datetime.timedelta(days=days)))
+            elif name == 'work_center' and value is not None:
+                # The new productions may be assigned a child work center
+                domain.append((name, 'child_of', [value], 'parent'))
+            else:
+                domain.append((name, '=', value))
+        productions = cls.search(domain, order=[('id', 'ASC')], limit=1)
+        if productions:
+            production, = productions
+            return production
+
+    def is_supply_changed(self):
+        """Return if the BOM or the route changed since the creation
+
+        The BOM is changed too when its lines do not give anymore the products
+        and units of the moves, like when a line is deleted."""
+        records = []
+        if self.bom:
+            records.append(self.bom)
+            records.extend(self.bom.inputs)
+            records.extend(self.bom.outputs)
+        for name in ['route', 'routing']:
+            route = getattr(self, name, None)
+            if route:
+                records.append(route)
+                records.extend(getattr(route, 'operations', []))
+                records.extend(getattr(route, 'steps', []))
+        for record in records:
+            date = record.write_date or record.create_date
+            if date and date > self.create_date:
+                return True
+        if self.bom:
+            moves = self._get_bom_moves(self.quantity)
+            if moves is None:
+                return True
+            for name in ['inputs', 'outputs']:
+                if (sorted((p, u) for p, u, _ in moves[name])
+                        != sorted((m.product.id, m.unit.id)
+                            for m in getattr(self, name))):
+                    return True
+        return False
+
+    def _get_bom_moves(self, quantity):
+        """Return the product, unit and quantity of the moves exploded from
+        the BOM for the quantity or None when they can not be computed"""
+        if (not (self.bom and self.product and self.unit)
+                or self._is_explode_bom_customized()):
+            return
+        factor_type = 'inputs' if self.type == 'disassembly' else 'outputs'
+        template = self._get_cached_explode_bom_template(factor_type)
+        if template is None:
+            return
+        return self._get_explode_bom_moves(template, quantity)
+
+    def rescale(self, quantity):
+        """Change the draft moves and the operations to the new quantity
+
+        The quantities of the moves are computed from the unrounded quantities
+        of the BOM so the rounding errors do not add up. The moves are matched
+        by product and unit and the changed quantities are written at once.
+        The production is not saved."""
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        to_write = []
+        moves = self._get_bom_moves(quantity) if self.bom else None
+        for name in ['inputs', 'outputs'] if moves else []:
+            key2quantities = defaultdict(list)
+            for product_id, unit_id, move_quantity in moves[name]:
+                key2quantities[(product_id, unit_id)].append(move_quantity)
+            for move in sorted(getattr(self, name), key=lambda m: m.id):
+                quantities = key2quantities[(move.product.id, move.unit.id)]
+                if not quantities:
+                    continue
+                move_quantity = quantities.pop(0)
+                if move.state not in {'staging', 'draft'}:
+                    continue
+                if move_quantity != move.quantity:
+                    to_write.extend(([move], {'quantity': move_quantity}))
+        if to_write:
+            Move.write(*to_write)
+        self.quantity = quantity
+        if getattr(self, 'route', None):
+            self.explode_route()
+
+    @classmethod
+    def save_with_moves(cls, productions):
+        """Save productions and then all their moves at once
+
+        The moves are created with a single call instead of one nested create
+        per production."""
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        moves = []
+        for production in productions:
+            input_date, output_date = production._get_move_planned_date()
+            for move in getattr(production, 'inputs', None) or []:
+                move.planned_date = input_date
+                moves.append(move)
+            for move in getattr(production, 'outputs', None) or []:
+                move.planned_date = output_date
+                moves.append(move)
+            production.inputs = []
+            production.outputs = []
+        cls.save(productions)
+        Move.save(moves)
+
+    @classmethod
+    def copy(cls, productions, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('sale_line_shares', None)
+        default.setdefault('sale_shared', False)
+        return super().copy(productions, default=default)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('done')
+    @process_sale()
+    def do(cls, productions):
+        super().do(productions)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancelled')
+    @process_sale()
+    def cancel(cls, productions):
+        super().cancel(productions)
+
     @classmethod
     @process_sale()
     def delete(cls, productions):
@@ -74,27 +672,30 @@ class ChangeQuantity(Wizard):
     def default_start(self, fields):
         pool = Pool()
         Production = pool.get('production')
-        SaleLine = Pool().get('sale.line')
 
         production = Production(Transaction().context['active_id'])
         if production.state not in ('draft', 'waiting'):
             raise UserError(gettext(
                 'sale_supply_production.invalid_production_state',
                 production=production.rec_name))
-        if not isinstance(production.origin, SaleLine):
+        if (not production.sale_line
+                or production.product != production.sale_line.product):
             raise UserError(gettext(
                 'sale_supply_production.production_no_related_to_sale'))
 
-        productions = Production.search(['origin','=', str(production.origin)])
+        productions = Production.search([
+                ('sale_line', '=', production.sale_line.id),
+                ('product', '=', production.product.id),
+                ])
         if len(productions) != 1:
             raise UserError(gettext(
                 'sale_supply_production.production_with_same_origin',
                 productions=",".join([x.rec_name for x in productions]),
-                sale_line=production.origin.rec_name))
+                sale_line=production.sale_line.rec_name))
 
         return {
             'production': production.id,
-            'sale_line': production.origin.id,
+            'sale_line': production.sale_line.id,
             'current_quantity': production.quantity,
             'uom': production.unit.id,
             }
@@ -120,3 +721,209 @@ class ChangeQuantity(Wizard):
         sale_change_quantity.start.unit = sale_line.unit
         sale_change_quantity.transition_modify()
         return 'end'
+
+
+class ChangeQuantitiesStart(ModelView):
+    'Change Productions Quantity - Start'
+    __name__ = 'production.change_quantities.start'
+
+    lines = fields.One2Many(
+        'production.change_quantities.line', None, "Lines")
+    file = fields.Binary(
+        "File",
+        help="A CSV file with the number of the production and the new "
+        "quantity on each row.")
+
+
+class ChangeQuantitiesLine(ModelView):
+    'Change Productions Quantity - Line'
+    __name__ = 'production.change_quantities.line'
+
+    production = fields.Many2One('production', "Production", readonly=True)
+    sale_line = fields.Many2One('sale.line', "Sale Line", readonly=True)
+    current_quantity = fields.Float(
+        "Current Quantity", digits='unit', readonly=True)
+    new_quantity = fields.Float(
+        "New Quantity", digits='unit', required=True,
+        domain=[
+            ('new_quantity', '>', 0),
+            ])
+    unit = fields.Many2One('product.uom', "Unit", readonly=True)
+
+    @classmethod
+    def get_production_values(cls, production, quantity=None):
+        return {
+            'production': production.id,
+            'sale_line': production.sale_line.id
+            if production.sale_line else None,
+            'current_quantity': production.quantity,
+            'new_quantity': (
+                quantity if quantity is not None else production.quantity),
+            'unit': production.unit.id,
+            }
+
+
+class ChangeQuantities(Wizard):
+    'Change Productions Quantity'
+    __name__ = 'production.change_quantities'
+
+    start = StateView('production.change_quantities.start',
+        'sale_supply_production.production_change_quantities_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-import'),
+            Button('Modify', 'modify', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    modify = StateTransition()
+
+    def default_start(self, fields):
+        pool = Pool()
+        Line = pool.get('production.change_quantities.line')
+        return {
+            'lines': [Line.get_production_values(p) for p in self.records],
+            }
+
+    def value_start(self, fields):
+        pool = Pool()
+        Line = pool.get('production.change_quantities.line')
+        if not getattr(self.start, 'file', None):
+            return {}
+        return {
+            'lines': [
+                Line.get_production_values(l.production, l.new_quantity)
+                for l in self.start.lines],
+            }
+
+    def transition_import_(self):
+        pool = Pool()
+        Production = pool.get('production')
+        Line = pool.get('production.change_quantities.line')
+
+        rows = []
+        if self.start.file:
+            data = bytes(self.start.file).decode('utf-8-sig')
+            try:
+                dialect = csv.Sniffer().sniff(data[:4096], delimiters=',;\t')
+            except csv.Error:
+                dialect = csv.excel
+            rows = [(i + 1, [c.strip() for c in row])
+                for i, row in enumerate(
+                    csv.reader(io.StringIO(data), dialect))
+                if any(c.strip() for c in row)]
+
+        number2production = {
+            p.number: p for p in Production.search([
+                    ('number', 'in', list({r[0] for _, r in rows})),
+                    ])}
+
+        def parse_quantity(row):
+            try:
+                return float(row[1])
+            except (IndexError, ValueError):
+                return None
+
+        # The header is the first row without quantity that is not a
+        # production
+        if (rows and rows[0][1][0] not in number2production
+                and parse_quantity(rows[0][1]) is None):
+            rows = rows[1:]
+
+        number2quantity = {}
+        for i, row in rows:
+            if len(row) < 2 or not row[0] or not row[1]:
+                raise UserError(gettext(
+                        'sale_supply_production.invalid_csv_row',
+                        row=i))
+            number, quantity = row[0], parse_quantity(row)
+            if quantity is None:
+                raise UserError(gettext(
+                        'sale_supply_production.invalid_csv_quantity',
+                        production=number, quantity=row[1], row=i))
+            if number not in number2production:
+                raise UserError(gettext(
+                        'sale_supply_production.unknown_csv_production',
+                        production=number, row=i))
+            if number2quantity.setdefault(number, quantity) != quantity:
+                raise UserError(gettext(
+                        'sale_supply_production.duplicated_csv_production',
+                        production=number, row=i))
+        self.start.lines = [
+            Line(**Line.get_production_values(number2production[n], q))
+            for n, q in number2quantity.items()]
+        return 'start'
+
+    def get_line_quantities(self):
+        """Return the new quantity of each sale line to change
+
+        All the lines are validated before any change is made."""
+        pool = Pool()
+        Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
+        Uom = pool.get('product.uom')
+
+        productions = set()
+        line2quantity = {}
+        for line in self.start.lines:
+            production = line.production
+            if production in productions:
+                raise UserError(gettext(
+                        'sale_supply_production.duplicated_production',
+                        production=production.rec_name))
+            productions.add(production)
+            if production.state not in ('draft', 'waiting'):
+                raise UserError(gettext(
+                        'sale_supply_production.invalid_production_state',
+                        production=production.rec_name))
+            sale_line = production.sale_line
+            if not sale_line or production.product != sale_line.product:
+                raise UserError(gettext(
+                        'sale_supply_production.production_no_related_to_sale',
+                        production=production.rec_name))
+            if line.new_quantity == production.quantity:
+                continue
+            line2quantity.setdefault(sale_line, sale_line.quantity)
+            line2quantity[sale_line] += Uom.compute_qty(
+                production.unit, line.new_quantity - production.quantity,
+                sale_line.unit)
+
+        sale_lines = list(line2quantity.keys())
+        line2productions = SaleLine.get_production_ids(sale_lines)
+        line2produced = SaleLine.get_production_quantities(sale_lines)
+        for sale_line, quantity in line2quantity.items():
+            production_ids = line2productions[sale_line.id]
+            if len(production_ids) != 1:
+                raise UserError(gettext(
+                        'sale_supply_production.production_with_same_origin',
+                        productions=",".join(
+                            p.rec_name for p in Production.browse(
+                                production_ids)),
+                        sale_line=sale_line.rec_name))
+            produced = sum(
+                q for s, q in line2produced[sale_line.id].items()
+                if s in ('assigned', 'running', 'done', 'cancelled'))
+            if quantity < produced:
+                raise UserError(gettext(
+                        'sale_supply_production.quantity_already_produced'))
+        return line2quantity
+
+    def transition_modify(self):
+        pool = Pool()
+        SaleChangeLineQuantity = pool.get('sale.change_line_quantity',
+            type='wizard')
+
+        line2quantity = self.get_line_quantities()
+        with measure('production.change_quantities',
+                records=len(line2quantity)), defer_process_sale():
+            for sale_line, quantity in line2quantity.items():
+                session_id, _, _ = SaleChangeLineQuantity.create()
+                sale_change_quantity = SaleChangeLineQuantity(session_id)
+                sale_change_quantity.start.sale = sale_line.sale
+                sale_change_quantity.start.line = sale_line
+                sale_change_quantity.start.current_quantity = (
+                    sale_line.quantity)
+                sale_change_quantity.start.new_quantity = quantity
+                sale_change_quantity.start.unit = sale_line.unit
+                sale_change_quantity.transition_modify()
+                SaleChangeLineQuantity.delete(session_id)
+        return 'end'
@@ -0,0 +1,25 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class Route(metaclass=PoolMeta):
+    __name__ = 'production.route'
+
+    @classmethod
+    def on_modification(cls, mode, routes, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, routes, field_names=field_names)
+        Production._route_operations_cache.clear()
+
+
+class RouteOperation(metaclass=PoolMeta):
+    __name__ = 'production.route.operation'
+
+    @classmethod
+    def on_modification(cls, mode, operations, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, operations, field_names=field_names)
+        Production._route_operations_cache.clear()
@@ -1,60 +1,464 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import hashlib
+import logging
+import warnings
+from collections import defaultdict
+
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
+
+import trytond.config as config
 from trytond.exceptions import UserError, UserWarning
 from trytond.i18n import gettext
-from trytond.model import fields
+from trytond.model import Index, ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
+from trytond.wizard import Button, StateView, Wizard
+
+from .tools import measure, stats
+
+logger = logging.getLogger(__name__)
 
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
-    productions = fields.Function(fields.Many2Many('production', None, None,
-        'Productions'), 'get_productions')
+    productions = fields.Function(fields.Many2Many(
+            'production', None, None, "Productions", order=[('id', 'ASC')],
+            help="The productions of the sale and the productions shared "
+            "with other sales."),
+        'get_productions')
+    pending_production_tasks = fields.Function(fields.Integer(
+            "Pending Production Tasks",
+            help="The number of queued tasks not yet started that create the "
+            "productions."),
+        'get_pending_production_tasks')
 
     @classmethod
     def confirm(cls, sales):
         Warning = Pool().get('res.user.warning')
 
-        for sale in sales:
-            warning_lines = False
-            for line in sale.lines:
-                if (line.type == 'line' and line.product
-                        and getattr(line.product, 'producible', False)
-                            and hasattr(line, 'cost_plan') and not line.cost_plan):
-                    warning_lines = True
-                    break
-            key = 'missing_cost_plan_%s' % sale.id
-            if warning_lines and Warning.check(key):
-                raise UserWarning(key,
-                    gettext('sale_supply_production.missing_cost_plan',
-                        sale=sale.rec_name))
+        with measure('sale.confirm.cost_plan', records=len(sales)):
+            sale_ids = cls._get_missing_cost_plan_sale_ids(sales)
+            for sale in sales:
+                key = 'missing_cost_plan_%s' % sale.id
+                if sale.id in sale_ids and Warning.check(key):
+                    raise UserWarning(key,
+                        gettext('sale_supply_production.missing_cost_plan',
+                            sale=sale.rec_name))
         super(Sale, cls).confirm(sales)
 
+    @classmethod
+    def _get_missing_cost_plan_sale_ids(cls, sales):
+        "Return the ids of the sales with producible lines without cost plan"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        line = SaleLine.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        sale_ids = set()
+        if 'cost_plan' not in SaleLine._fields:
+            return sale_ids
+        for sub_sales in grouped_slice(sales):
+            cursor.execute(*line.join(product,
+                    condition=line.product == product.id
+                    ).join(template,
+                    condition=product.template == template.id
+                    ).select(line.sale,
+                    where=reduce_ids(line.sale, [s.id for s in sub_sales])
+                    & (line.type == 'line')
+                    & (template.producible == Literal(True))
+                    & (line.cost_plan == Null),
+                    group_by=[line.sale]))
+            sale_ids.update(s for s, in cursor)
+        return sale_ids
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'get_material_requirements': RPC(
+                    instantiate=0, readonly=True),
+                })
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        if cls.create_productions is not Sale.create_productions:
+            warnings.warn(
+                "sale.sale.create_productions is deprecated, it is still "
+                "called by process for each sale but override "
+                "sale.line.compute_productions instead",
+                DeprecationWarning)
+
     @classmethod
     def process(cls, sales):
-        for sale in sales:
-            if sale.state in ('done', 'cancelled'):
-                continue
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        values = Configuration.get_supply_production_values()
+
+        to_produce = [s for s in sales if s.state not in ('done', 'cancelled')]
+        if to_produce:
             with Transaction().set_user(0, set_context=True):
-                sale.create_productions()
+                # The overrides of create_productions are called for each sale
+                if (values['queue']
+                        and cls.create_productions is Sale.create_productions):
+                    cls._queue_productions(to_produce)
+                else:
+                    cls._create_productions(to_produce)
         super(Sale, cls).process(sales)
 
     def create_productions(self):
-        productions = []
-        for line in self.lines:
-            if line.supply_production:
-                new_productions = line.create_productions()
-                if new_productions:
-                    productions += new_productions
-        return productions
+        """Deprecated: override sale.line.compute_productions instead
 
-    def get_productions(self, name):
-        productions = []
-        for line in self.lines:
-            productions.extend([p.id for p in line.productions])
-        return productions
+        It is called by process for each sale only when it is overridden."""
+        return self._create_sales_productions([self])
+
+    @classmethod
+    def _queue_productions(cls, sales):
+        """Queue the creation of the productions of the sales
+
+        The lines are split in tasks of the configured size. The sales with
+        tasks not yet started are skipped."""
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        SaleLine = pool.get('sale.line')
+        SaleTask = pool.get('sale.sale-ir.queue')
+        values = Configuration.get_supply_production_values()
+        size = values['queue_size'] or 100
+        queue_name = cls._get_process_queue_name()
+
+        pending = cls._get_pending_production_tasks(sales)
+        sales = [s for s in sales if not pending.get(s.id)]
+        line2sale = SaleLine._get_lines_to_produce(sales)
+        sale2lines = defaultdict(list)
+        for line_id, sale_id in line2sale.items():
+            sale2lines[sale_id].append(line_id)
+        to_link = []
+        for sale in sales:
+            lines = SaleLine.browse(sorted(sale2lines[sale.id]))
+            if not lines:
+                continue
+            with Transaction().set_context(
+                    queue_name=queue_name,
+                    queue_batch=size):
+                task_ids = SaleLine.__queue__.create_queued_productions(lines)
+            to_link.extend({
+                    'sale': sale.id,
+                    'task': t,
+                    'type': 'productions',
+                    } for t in task_ids or [])
+        if to_link:
+            SaleTask.create(to_link)
+
+    @classmethod
+    def get_productions(cls, sales, name):
+        pool = Pool()
+        Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
+        Share = pool.get('sale.line-production')
+        production = Production.__table__()
+        line = SaleLine.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        sale2productions = {s.id: [] for s in sales}
+        for sub_sales in grouped_slice(sales):
+            sale_ids = [s.id for s in sub_sales]
+            query = production.select(production.sale, production.id,
+                where=reduce_ids(production.sale, sale_ids))
+            query |= share.join(line,
+                condition=share.sale_line == line.id
+                ).select(line.sale, share.production,
+                    where=reduce_ids(line.sale, sale_ids))
+            cursor.execute(*query)
+            for sale_id, production_id in cursor:
+                sale2productions[sale_id].append(production_id)
+        for production_ids in sale2productions.values():
+            production_ids.sort()
+        return sale2productions
+
+    @classmethod
+    def get_pending_production_tasks(cls, sales, name):
+        pending = cls._get_pending_production_tasks(sales)
+        return {s.id: pending.get(s.id, 0) for s in sales}
+
+    @classmethod
+    def _get_pending_production_tasks(cls, sales):
+        """Return the number of tasks not yet started that create the
+        productions by sale id
+
+        The failed tasks must not block the sale and the running tasks lock
+        their lines, which are skipped once supplied, so only the tasks not
+        yet dequeued are counted. The tasks are found through the tasks linked
+        to the sales with one query."""
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        SaleTask = pool.get('sale.sale-ir.queue')
+        queue = Queue.__table__()
+        sale_task = SaleTask.__table__()
+        cursor = Transaction().connection.cursor()
+
+        pending = {}
+        for sub_sales in grouped_slice(sales):
+            cursor.execute(*sale_task.join(queue,
+                    condition=sale_task.task == queue.id
+                    ).select(sale_task.sale, Count(sale_task.task),
+                    where=reduce_ids(sale_task.sale, [s.id for s in sub_sales])
+                    & (sale_task.type == 'productions')
+                    & (queue.dequeued_at == Null),
+                    group_by=[sale_task.sale]))
+            pending.update(cursor)
+        return pending
+
+    @classmethod
+    def queue_process(cls, sale_ids):
+        """Queue the process of the sales
+
+        The tasks are pushed to the queue named by process_sale_queue_name.
+        When process_sale_delay is set, the tasks are scheduled after that
+        number of seconds and the sales that are already waiting in a
+        scheduled task are merged into it instead of being queued again."""
+        pool = Pool()
+        SaleTask = pool.get('sale.sale-ir.queue')
+        transaction = Transaction()
+        context = transaction.context
+        batch_size = config.getint(
+            'sale_supply_production', 'process_sale_batch_size', default=0)
+        delay = config.getint(
+            'sale_supply_production', 'process_sale_delay', default=0)
+        margin = config.getint(
+            'sale_supply_production', 'process_sale_merge_margin',
+            default=10)
+        queue_name = context.get('queue_name', cls._get_process_queue_name())
+
+        scheduled_at = None
+        to_queue = list(sale_ids)
+        if delay:
+            scheduled_at = datetime.timedelta(seconds=delay)
+            pending = cls._get_scheduled_process_ids(
+                sale_ids, scheduled_at, datetime.timedelta(seconds=margin))
+            to_queue = [i for i in to_queue if i not in pending]
+        merged = len(sale_ids) - len(to_queue)
+        stats.add('sale.queue_process.queued', 0, None, len(to_queue))
+        stats.add('sale.queue_process.merged', 0, None, merged)
+        if merged:
+            logger.debug("Merged the process of %s sales", merged)
+        batch = context.get('queue_batch', batch_size or True)
+        if batch is True or not batch:
+            batch = len(to_queue) or 1
+        to_link = []
+        for sub_ids in grouped_slice(to_queue, batch):
+            sub_ids = list(sub_ids)
+            with transaction.set_context(
+                    queue_name=queue_name,
+                    queue_batch=True,
+                    queue_scheduled_at=context.get(
+                        'queue_scheduled_at', scheduled_at)):
+                task_ids = cls.__queue__.process(sub_ids)
+            if delay:
+                to_link.extend({
+                        'sale': i,
+                        'task': t,
+                        'type': 'process',
+                        } for t in task_ids or [] for i in sub_ids)
+        if to_link:
+            SaleTask.create(to_link)
+
+    @classmethod
+    def _get_process_queue_name(cls):
+        return config.get(
+            'sale_supply_production', 'process_sale_queue_name',
+            default='sale_supply_production')
+
+    @classmethod
+    def _get_scheduled_process_ids(cls, sale_ids, delay, margin):
+        """Return the ids of the sales in process tasks not yet started and
+        scheduled within the delay
+
+        The tasks scheduled before the margin are ignored because they may be
+        started before the transaction is committed and process the sales
+        without its changes."""
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        SaleTask = pool.get('sale.sale-ir.queue')
+        queue = Queue.__table__()
+        sale_task = SaleTask.__table__()
+        cursor = Transaction().connection.cursor()
+
+        now = datetime.datetime.now()
+        scheduled_ids = set()
+        for sub_ids in grouped_slice(sale_ids):
+            cursor.execute(*sale_task.join(queue,
+                    condition=sale_task.task == queue.id
+                    ).select(sale_task.sale,
+                    where=reduce_ids(sale_task.sale, sub_ids)
+                    & (sale_task.type == 'process')
+                    & (queue.dequeued_at == Null)
+                    & (queue.scheduled_at > now + margin)
+                    & (queue.scheduled_at <= now + delay),
+                    group_by=[sale_task.sale]))
+            scheduled_ids.update(s for s, in cursor)
+        return scheduled_ids
+
+    @classmethod
+    def get_material_requirements(cls, sales):
+        """Return the component quantities the productions of the sales need
+
+        The result is a list of dictionaries with the warehouse, the date, the
+        product, the unit and the quantity. It is computed, without creating
+        any production, by multiplying the quantities of the products to
+        produce by the input coefficients of their BOM. The components are
+        expanded when the productions of the components are created."""
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        Configuration = pool.get('sale.configuration')
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
+        Uom = pool.get('product.uom')
+        config = Configuration.get_supply_production_values()
+
+        product2values = {}
+        matrix = {}
+
+        def get_coefficients(product, bom, path, pattern):
+            key = (product.id, bom.id, pattern)
+            if key in matrix:
+                return matrix[key]
+            production = Production(
+                type='assembly', product=product, bom=bom,
+                unit=product.default_uom)
+            coefficients = defaultdict(float)
+            for component_id, coefficient in (
+                    production.get_input_coefficients() or {}).items():
+                coefficients[component_id] += coefficient
+                if not config['components'] or component_id in path:
+                    continue
+                component = Product(component_id)
+                if not component.template.producible:
+                    continue
+                if (component_id, pattern) not in product2values:
+                    product2values[(component_id, pattern)] = (
+                        SaleLine._get_bom_production_values(
+                            component, pattern=dict(pattern)))
+                component_bom = product2values[
+                    (component_id, pattern)].get('bom')
+                if component_bom:
+                    for product_id, quantity in get_coefficients(
+                            component, component_bom,
+                            path | {component_id}, pattern).items():
+                        coefficients[product_id] += coefficient * quantity
+            matrix[key] = dict(coefficients)
+            return matrix[key]
+
+        to_plan = []
+        lines = []
+        for sub_sales in grouped_slice(sales):
+            lines.extend(SaleLine.search([
+                        ('sale', 'in', [s.id for s in sub_sales]),
+                        ('type', '=', 'line'),
+                        ('supply_production', '=', True),
+                        ], order=[('id', 'ASC')]))
+        for line in lines:
+            for values in line.get_productions_values():
+                if not values.get('bom'):
+                    continue
+                production = Production(
+                    type='assembly', state='draft', product=values['product'],
+                    bom=values['bom'],
+                    planned_date=line.get_production_planned_date())
+                to_plan.append((line, values, production))
+        Production.set_planned_start_dates([p for _, _, p in to_plan])
+
+        demand = defaultdict(float)
+        for line, values, production in to_plan:
+            product = values['product']
+            unit = values.get('unit', product.default_uom)
+            key = (line.warehouse.id if line.warehouse else None,
+                production.planned_start_date, product.id, values['bom'].id,
+                tuple(sorted(line._get_bom_pattern().items())))
+            demand[key] += Uom.compute_qty(
+                unit, values['quantity'], product.default_uom, round=False)
+
+        requirements = defaultdict(float)
+        for (warehouse, date, product_id, bom_id, pattern), quantity in (
+                demand.items()):
+            coefficients = get_coefficients(
+                Product(product_id), BOM(bom_id),
+                frozenset([product_id]), pattern)
+            for component_id, coefficient in coefficients.items():
+                requirements[(warehouse, date, component_id)] += (
+                    quantity * coefficient)
+
+        result = []
+        for (warehouse, date, product_id), quantity in sorted(
+                requirements.items(),
+                key=lambda i: (i[0][0] or 0, i[0][1] or datetime.date.min,
+                    i[0][2])):
+            unit = Product(product_id).default_uom
+            result.append({
+                    'warehouse': warehouse,
+                    'date': date,
+                    'product': product_id,
+                    'unit': unit.id,
+                    'quantity': unit.round(quantity),
+                    })
+        return result
+
+    @classmethod
+    def _create_productions(cls, sales):
+        """Create the productions of the sales
+
+        The productions are created for each sale by create_productions when
+        it is overridden, otherwise for all the sales at once."""
+        if cls.create_productions is not Sale.create_productions:
+            productions = []
+            for sale in sales:
+                productions.extend(sale.create_productions() or [])
+            return productions
+        return cls._create_sales_productions(sales)
+
+    @classmethod
+    def _create_sales_productions(cls, sales):
+        """Create the productions of all sales with one save per model
+
+        When create_productions_chunk_size is set, the lines are supplied by
+        chunks of that size and the record cache is cleared after each chunk
+        so the memory used does not grow with the number of lines. All the
+        lines are locked once before the first chunk."""
+        pool = Pool()
+        Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
+        transaction = Transaction()
+        size = config.getint(
+            'sale_supply_production', 'create_productions_chunk_size',
+            default=0)
+
+        line_ids = sorted(SaleLine._get_lines_to_produce(sales))
+        with measure('sale.create_productions', records=len(line_ids)):
+            SaleLine.lock(SaleLine.browse(line_ids))
+            if not size or len(line_ids) <= size:
+                return SaleLine._create_productions(
+                    SaleLine.browse(line_ids), lock=False)
+            production_ids = []
+            for sub_line_ids in grouped_slice(line_ids, size):
+                productions = SaleLine._create_productions(
+                    SaleLine.browse(list(sub_line_ids)), lock=False)
+                production_ids.extend(p.id for p in productions)
+                del productions
+                for cache in transaction.cache.values():
+                    cache.clear()
+            return Production.browse(production_ids)
 
 
 class SaleLine(metaclass=PoolMeta):
@@ -63,13 +467,35 @@ class SaleLine(metaclass=PoolMeta):
         states={
             'readonly': Eval('sale_state') != 'draft',
             })
-    productions = fields.One2Many('production', 'origin', 'Productions',
-        readonly=True)
+    productions = fields.Function(fields.Many2Many(
+            'production', None, None, "Productions", order=[('id', 'ASC')],
+            help="The productions of the line and the productions shared "
+            "with other lines."),
+        'get_productions', searcher='search_productions')
+    production_shares = fields.One2Many(
+        'sale.line-production', 'sale_line', "Production Shares",
+        readonly=True,
+        help="The quantities of the line supplied by shared productions.")
+    production_fingerprint = fields.Char(
+        "Production Fingerprint", readonly=True,
+        help="The digest of the values used to create the productions "
+        "when the sale was last processed.")
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        if cls.create_productions is not SaleLine.create_productions:
+            warnings.warn(
+                "sale.line.create_productions is deprecated, it is still "
+                "called by sale.sale.process for each line but override "
+                "compute_productions instead",
+                DeprecationWarning)
 
     @staticmethod
     def default_supply_production():
         SaleConfiguration = Pool().get('sale.configuration')
-        return SaleConfiguration(1).sale_supply_production_default
+        values = SaleConfiguration.get_supply_production_values()
+        return values['supply_production_default']
 
     @property
     def quantity_to_production(self):
@@ -83,13 +509,624 @@ class SaleLine(metaclass=PoolMeta):
         if self.product:
             self.supply_production = self.product.supply_production_on_sale
 
+    @classmethod
+    def get_productions(cls, lines, name):
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        production = Production.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line2productions = {l.id: [] for l in lines}
+        for sub_lines in grouped_slice(lines):
+            line_ids = [l.id for l in sub_lines]
+            query = production.select(production.sale_line, production.id,
+                where=reduce_ids(production.sale_line, line_ids))
+            query |= share.select(share.sale_line, share.production,
+                where=reduce_ids(share.sale_line, line_ids))
+            cursor.execute(*query)
+            for line_id, production_id in cursor:
+                line2productions[line_id].append(production_id)
+        for production_ids in line2productions.values():
+            production_ids.sort()
+        return line2productions
+
+    @classmethod
+    def search_productions(cls, name, clause):
+        """Search the lines of the productions matching the clause
+
+        The negative operators match the lines without any production
+        matching the positive clause like for the One2Many fields."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        production = Production.__table__()
+        share = Share.__table__()
+
+        _, operator, value = clause[:3]
+        nested = clause[0][len(name) + 1:]
+        negative = operator == '!=' or operator.startswith('not ')
+        if negative:
+            operator = '=' if operator == '!=' else operator[len('not '):]
+        if nested:
+            domain = [(nested, operator, value) + tuple(clause[3:])]
+        elif value is None and operator == '=':
+            # No production is searched as the lines without any production
+            domain = []
+            negative = not negative
+        elif isinstance(value, str):
+            domain = [('rec_name', operator, value)]
+        else:
+            domain = [('id', operator, value)]
+        production_ids = Production.search(domain, order=[], query=True)
+        query = production.select(production.sale_line,
+            where=production.id.in_(production_ids)
+            & (production.sale_line != Null))
+        query |= share.select(share.sale_line,
+            where=share.production.in_(production_ids))
+        return [('id', 'not in' if negative else 'in', query)]
+
+    @classmethod
+    def get_production_ids(cls, lines):
+        """Return a dictionary with the ids of the productions of each line
+
+        The productions of the components of the line are excluded."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        line = cls.__table__()
+        production = Production.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line2productions = {l.id: [] for l in lines}
+        for sub_lines in grouped_slice(lines):
+            line_ids = [l.id for l in sub_lines]
+            query = production.join(line,
+                condition=production.sale_line == line.id
+                ).select(line.id, production.id,
+                    where=reduce_ids(line.id, line_ids)
+                    & (production.product == line.product))
+            query |= share.join(line,
+                condition=share.sale_line == line.id
+                ).join(production,
+                    condition=share.production == production.id
+                ).select(line.id, production.id,
+                    where=reduce_ids(line.id, line_ids)
+                    & (production.product == line.product))
+            cursor.execute(*query)
+            for line_id, production_id in cursor:
+                line2productions[line_id].append(production_id)
+        for production_ids in line2productions.values():
+            production_ids.sort()
+        return line2productions
+
+    @classmethod
+    def get_production_quantities(cls, lines):
+        """Return a dictionary with the quantity by production state of each
+        line expressed in the unit of the line
+
+        The quantities are summed by state and unit with a query and
+        converted with the cached conversion factors."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        Uom = pool.get('product.uom')
+        line = cls.__table__()
+        production = Production.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        id2line = {l.id: l for l in lines}
+        quantities = {l.id: defaultdict(float) for l in lines}
+        for sub_lines in grouped_slice(lines):
+            line_ids = [l.id for l in sub_lines]
+            for query in [
+                    production.join(line,
+                        condition=production.sale_line == line.id
+                        ).select(line.id, production.state, production.unit,
+                            Sum(production.quantity),
+                            where=reduce_ids(line.id, line_ids)
+                            & (production.product == line.product),
+                            group_by=[line.id, production.state,
+                                production.unit]),
+                    share.join(line,
+                        condition=share.sale_line == line.id
+                        ).join(production,
+                            condition=share.production == production.id
+                        ).select(line.id, production.state, production.unit,
+                            Sum(share.quantity),
+                            where=reduce_ids(line.id, line_ids)
+                            & (production.product == line.product),
+                            group_by=[line.id, production.state,
+                                production.unit]),
+                    ]:
+                cursor.execute(*query)
+                for line_id, state, unit_id, quantity in cursor:
+                    factor = Uom.get_conversion_factor(
+                        Uom(unit_id), id2line[line_id].unit)
+                    quantities[line_id][state] += (quantity or 0) * factor
+        return {
+            l: {s: id2line[l].unit.round(q) for s, q in states.items()}
+            for l, states in quantities.items()}
+
+    @classmethod
+    def _create_productions(cls, lines, lock=True):
+        """Create the productions of the lines with one save per model
+
+        The lines are locked so concurrent transactions can not supply them
+        twice, unless lock is unset because the caller locked them already.
+        When create_productions is overridden, it is called for each line."""
+        pool = Pool()
+        Production = pool.get('production')
+        Product = pool.get('product.product')
+        Configuration = pool.get('sale.configuration')
+        Share = pool.get('sale.line-production')
+        config = Configuration.get_supply_production_values()
+
+        days = config['consolidate_days'] or 1
+
+        if lock:
+            cls.lock(lines)
+        if cls.create_productions is not SaleLine.create_productions:
+            productions = []
+            for line in lines:
+                productions.extend(line.create_productions() or [])
+            cls._store_production_fingerprints(lines)
+            return productions
+        line2productions = cls.get_production_ids(lines)
+        to_supply = [l for l in lines if not line2productions[l.id]]
+        # Read the product BOMs and the lead times of all the lines at once
+        Product.get_boms([l.product for l in to_supply if l.product])
+        Production.load_lead_times([l.product for l in to_supply])
+        line2values = {l.id: l.get_productions_values() for l in to_supply}
+        productions, to_consolidate, shares = [], [], []
+        line_productions = []
+        reused = set()
+        if config['reuse']:
+            reusable = cls._get_reusable_productions(
+                [(l, v[0]) for l in to_supply
+                    for v in [line2values[l.id]] if len(v) == 1],
+                config['reuse_days'] or 0)
+        for line in to_supply:
+            productions_values = line2values[line.id]
+            if config['reuse'] and len(productions_values) == 1:
+                values, reused_shares = line._reuse_productions(
+                    productions_values[0], reusable,
+                    config['reuse_days'] or 0)
+                shares.extend(reused_shares)
+                reused.update(s.production for s in reused_shares)
+                productions_values = [values] if values else []
+            if config['consolidate'] and len(productions_values) == 1:
+                to_consolidate.extend(
+                    (line, p) for p in line.compute_productions(
+                        productions_values, explode=False))
+                continue
+            line_productions.extend(
+                (line, p) for p in line.compute_productions(
+                    productions_values))
+        if reused:
+            Production.lock(sorted(reused, key=lambda p: p.id))
+        productions.extend(p for _, p in line_productions)
+        if config['components']:
+            # The productions are exploded before being merged to get the
+            # components of each line
+            for _, production in to_consolidate:
+                production.explode_supply()
+            component_line_ids = cls._get_component_line_ids(lines)
+            components, component_shares = cls._create_component_productions(
+                [(l, p) for l, p in line_productions + to_consolidate
+                    if l.id not in component_line_ids], days)
+            productions.extend(components)
+            shares.extend(component_shares)
+        if to_consolidate:
+            consolidated, consolidated_shares = cls._consolidate_productions(
+                to_consolidate, days, exploded=config['components'])
+            productions.extend(consolidated)
+            shares.extend(consolidated_shares)
+        if hasattr(Production, 'assign_work_centers'):
+            Production.assign_work_centers(productions)
+        with measure('sale_line.save', records=len(productions)):
+            Production.save_with_moves(productions)
+            Share.save(shares)
+        cls._store_production_fingerprints(lines)
+        return productions
+
+    @classmethod
+    def _get_reusable_productions(cls, line_values, days):
+        """Return the draft productions without origin that can supply the
+        line values indexed by company, warehouse, product and BOM
+
+        Each production is returned with its quantity not allocated to sale
+        lines and the productions are sorted by planned date. The lines without
+        planned date only reuse the productions without planned date. The
+        productions are not locked, the caller locks the ones allocated."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if not line_values:
+            return {}
+        dates = {l.get_production_planned_date() for l, _ in line_values}
+        date_domain = ['OR']
+        if None in dates:
+            dates.remove(None)
+            date_domain.append(('planned_date', '=', None))
+        if dates:
+            date_domain.append([
+                    ('planned_date', '>=',
+                        min(dates) - datetime.timedelta(days=days)),
+                    ('planned_date', '<=', max(dates)),
+                    ])
+        productions = Production.search([
+                ('state', '=', 'draft'),
+                ('origin', '=', None),
+                ('sale_line', '=', None),
+                ('sale_shared', '=', False),
+                ('warehouse', 'in', list({l.warehouse.id
+                            for l, _ in line_values if l.warehouse})),
+                ('product', 'in', list({v['product'].id
+                            for _, v in line_values})),
+                date_domain,
+                ], order=[('planned_date', 'ASC NULLS FIRST'), ('id', 'ASC')])
+        if not productions:
+            return {}
+
+        allocated = defaultdict(int)
+        for sub_productions in grouped_slice(productions):
+            cursor.execute(*share.select(
+                    share.production, Sum(share.quantity),
+                    where=reduce_ids(
+                        share.production, [p.id for p in sub_productions]),
+                    group_by=[share.production]))
+            allocated.update(cursor)
+
+        reusable = defaultdict(list)
+        for production in productions:
+            quantity = production.quantity - allocated[production.id]
+            if quantity < production.unit.rounding:
+                continue
+            key = (
+                production.company.id, production.warehouse.id,
+                production.product.id,
+                production.bom.id if production.bom else None)
+            reusable[key].append([production, quantity])
+        return reusable
+
+    def _reuse_productions(self, values, reusable, days):
+        """Allocate to the line the quantity not allocated of the reusable
+        productions for the values
+
+        Return the values of the quantity left to produce, or None, and the
+        shares of the line to save."""
+        pool = Pool()
+        Share = pool.get('sale.line-production')
+        Uom = pool.get('product.uom')
+
+        date = self.get_production_planned_date()
+        if not self.warehouse:
+            return values, []
+        bom = values.get('bom')
+        key = (
+            self.sale.company.id, self.warehouse.id, values['product'].id,
+            bom.id if bom else None)
+        unit = values.get('unit', values['product'].default_uom)
+        quantity = values['quantity']
+        shares = []
+        for candidate in reusable.get(key, []):
+            production, available = candidate
+            if available < production.unit.rounding:
+                continue
+            if not date or not production.planned_date:
+                if date != production.planned_date:
+                    continue
+            elif not (date - datetime.timedelta(days=days)
+                    <= production.planned_date <= date):
+                continue
+            share_quantity = min(
+                available,
+                Uom.compute_qty(unit, quantity, production.unit, round=False))
+            candidate[1] -= share_quantity
+            shares.append(Share(
+                    sale_line=self,
+                    production=production,
+                    quantity=share_quantity))
+            quantity -= Uom.compute_qty(
+                production.unit, share_quantity, unit, round=False)
+            if quantity < unit.rounding:
+                return None, shares
+        if shares:
+            values = values.copy()
+            values['quantity'] = unit.round(quantity)
+        return values, shares
+
+    @classmethod
+    def _get_component_line_ids(cls, lines):
+        "Return the ids of the lines that have component productions"
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        line = cls.__table__()
+        production = Production.__table__()
+        share = Share.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = set()
+        for sub_lines in grouped_slice(lines):
+            sub_ids = [l.id for l in sub_lines]
+            query = production.join(line,
+                condition=production.sale_line == line.id
+                ).select(line.id,
+                    where=reduce_ids(line.id, sub_ids)
+                    & (production.product != line.product))
+            query |= share.join(line,
+                condition=share.sale_line == line.id
+                ).join(production,
+                    condition=share.production == production.id
+                ).select(line.id,
+                    where=reduce_ids(line.id, sub_ids)
+                    & (production.product != line.product))
+            cursor.execute(*query)
+            line_ids.update(i for i, in cursor)
+        return line_ids
+
+    @classmethod
+    def _create_component_productions(cls, line_productions, days):
+        """Create the productions of the producible components
+
+        The BOM tree of the exploded productions is walked level by level.
+        The demand of each level is merged by supply across the lines and
+        the BOM of each component is searched only once. The productions of
+        the components always supply the lines through shares.
+        Return the productions and the shares of the lines to save."""
+        pool = Pool()
+        Production = pool.get('production')
+        product2values = {}
+        productions, shares = [], []
+        level = [(l, p, frozenset([p.product.id])) for l, p in line_productions]
+        first = True
+        while level:
+            demand = []
+            Production.load_lead_times([
+                    m.product for _, p, _ in level
+                    for m in getattr(p, 'inputs', None) or []])
+            for line, production, path in level:
+                for component, component_path in line._get_component_demand(
+                        production, path, product2values):
+                    component.explode_supply()
+                    demand.append((line, component, component_path))
+            if not first:
+                level_productions, level_shares = cls._consolidate_productions(
+                    [(l, p) for l, p, _ in level], days, exploded=True,
+                    shared=True)
+                productions.extend(level_productions)
+                shares.extend(level_shares)
+            level = demand
+            first = False
+        return productions, shares
+
+    def _get_component_demand(self, production, path, product2values):
+        """Yield the unsaved productions of the components of production
+
+        path contains the products of the branch to avoid cycles and
+        product2values memoizes the BOM values of the products by pattern."""
+        for move in getattr(production, 'inputs', None) or []:
+            product = move.product
+            if (product.id in path
+                    or not product.template.producible):
+                continue
+            pattern = self._get_bom_pattern()
+            key = (product.id, tuple(sorted(pattern.items())))
+            if key not in product2values:
+                product2values[key] = self._get_bom_production_values(
+                    product, pattern=pattern)
+            values = product2values[key]
+            if not values.get('bom'):
+                continue
+            values = values.copy()
+            values.update({
+                    'product': product,
+                    'unit': move.unit,
+                    'quantity': move.quantity,
+                    })
+            for component in self.compute_productions(
+                    [values], explode=False):
+                if hasattr(component, 'cost_plan'):
+                    component.cost_plan = None
+                component.planned_date = production.planned_start_date
+                component.set_planned_start_date()
+                yield component, path | {product.id}
+
+    @classmethod
+    def _consolidate_productions(
+            cls, line_productions, days, exploded=False, shared=False):
+        """Group the productions of the lines sharing the same supply
+
+        The productions of each group are merged into a draft shared
+        production, which is created or, when it exists, updated and saved.
+        The productions alone in their group are kept unless shared is set
+        and they are exploded unless exploded is set.
+        Return the productions and the shares of the lines to save."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        Uom = pool.get('product.uom')
+
+        key2productions = defaultdict(list)
+        for line, production in line_productions:
+            key = production.get_consolidation_key(days)
+            key2productions[key].append((line, production))
+
+        # The existing shared productions are locked at once before any change
+        key2target = {
+            k: Production.get_consolidated_production(k, days)
+            for k in key2productions}
+        targets = [t for t in key2target.values() if t]
+        if targets:
+            Production.lock(targets)
+
+        productions, shares = [], []
+        for key, group in key2productions.items():
+            target = key2target[key]
+            if not target and len(group) == 1 and not shared:
+                (_, production), = group
+                if not exploded:
+                    production.explode_supply()
+                productions.append(production)
+                continue
+
+            if target:
+                quantity = target.quantity
+                sales = {s.sale_line.sale for s in target.sale_line_shares}
+                dates = [target.planned_date]
+            else:
+                _, target = group[0]
+                quantity = 0
+                sales = set()
+                dates = []
+            for line, production in group:
+                quantity += Uom.compute_qty(
+                    production.unit, production.quantity, target.unit,
+                    round=False)
+                sales.add(line.sale)
+                dates.append(production.planned_date)
+                shares.append(Share(
+                        sale_line=line,
+                        production=target,
+                        quantity=Uom.compute_qty(
+                            production.unit, production.quantity,
+                            target.unit, round=False)))
+
+            target.origin = None
+            target.sale_line = None
+            target.sale_shared = True
+            target.sale = sales.pop() if len(sales) == 1 else None
+            target.reference = target.sale.reference if target.sale else None
+            dates = [d for d in dates if d]
+            target.planned_date = min(dates) if dates else None
+            target.set_planned_start_date()
+            quantity = target.unit.round(quantity)
+            if target.id is None or target.id < 0:
+                if not exploded or target.quantity != quantity:
+                    target.quantity = quantity
+                    target.explode_supply()
+                productions.append(target)
+            else:
+                target.set_quantity(quantity)
+                target.save()
+        return productions, shares
+
+    @classmethod
+    def _get_production_fingerprints(cls, where):
+        """Return the sale id, the stored and the current production
+        fingerprint of the supply production lines matching where
+
+        The values are read with a query, only the quantity to produce of the
+        producible lines without production is read from the instances."""
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        line = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [line.type, line.product, line.quantity, line.unit,
+            template.producible]
+        if 'cost_plan' in cls._fields:
+            columns.append(line.cost_plan)
+        cursor.execute(*line
+            .join(product, 'LEFT', condition=line.product == product.id)
+            .join(template, 'LEFT', condition=product.template == template.id)
+            .select(line.id, line.sale, line.production_fingerprint,
+                *columns,
+                where=where(line) & (line.supply_production == Literal(True))))
+        rows = cursor.fetchall()
+
+        lines = cls.browse([r[0] for r in rows])
+        id2line = {l.id: l for l in lines}
+        line2productions = cls.get_production_ids(lines)
+        fingerprints = {}
+        for line_id, sale_id, stored, *values in rows:
+            type_, product_id, *_, producible = values[:5]
+            production_ids = line2productions[line_id]
+            values.append(production_ids)
+            if (not production_ids and type_ == 'line' and product_id
+                    and producible):
+                # The quantity to produce may not depend only on the line
+                values.append(id2line[line_id].quantity_to_production)
+            current = hashlib.sha1(repr(values).encode()).hexdigest()
+            fingerprints[line_id] = (sale_id, stored, current)
+        return fingerprints
+
+    @classmethod
+    def _get_lines_to_produce(cls, sales):
+        """Return a dictionary with the sale id of the supply production lines
+        that changed since the last time the sales were processed"""
+        to_produce = {}
+        for sub_sales in grouped_slice(sales):
+            sale_ids = [s.id for s in sub_sales]
+            fingerprints = cls._get_production_fingerprints(
+                lambda line: reduce_ids(line.sale, sale_ids))
+            for line_id, (sale_id, stored, current) in fingerprints.items():
+                if stored != current:
+                    to_produce[line_id] = sale_id
+        return to_produce
+
+    @classmethod
+    def _store_production_fingerprints(cls, lines):
+        """Store the production fingerprint of the lines that changed
+
+        The lines of each slice are updated with one query."""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_lines in grouped_slice(lines):
+            line_ids = [l.id for l in sub_lines]
+            fingerprints = cls._get_production_fingerprints(
+                lambda line: reduce_ids(line.id, line_ids))
+            changed = {
+                i: c for i, (_, s, c) in fingerprints.items() if s != c}
+            if not changed:
+                continue
+            cursor.execute(*table.update(
+                    [table.production_fingerprint],
+                    [Case(*((table.id == i, c)
+                                for i, c in sorted(changed.items())))],
+                    where=reduce_ids(table.id, list(changed))))
+
+    @classmethod
+    def create_queued_productions(cls, lines):
+        with Transaction().set_user(0, set_context=True):
+            cls._create_productions([l for l in lines
+                    if l.sale.state not in ('done', 'cancelled')])
+
     def create_productions(self):
+        """Deprecated: override compute_productions instead
+
+        It is called by sale.sale.process for each line only when it is
+        overridden."""
+        pool = Pool()
+        Production = pool.get('production')
+        self.lock([self])
+        if self.get_production_ids([self])[self.id]:
+            return []
+        productions = self.compute_productions()
+        Production.save_with_moves(productions)
+        return productions
+
+    def get_productions_values(self):
+        "Return the values of the productions that supply the line"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
         if (self.type != 'line'
                 or not self.product
                 or not self.product.template.producible
                 or self.quantity_to_production <= 0
-                or hasattr(self, 'cost_plan') and not self.cost_plan
-                or len(self.productions) > 0):
+                or hasattr(self, 'cost_plan') and not self.cost_plan):
             return []
 
         if hasattr(self, 'cost_plan') and self.cost_plan:
@@ -101,60 +1138,91 @@ class SaleLine(metaclass=PoolMeta):
                 'unit': self.unit,
                 'quantity': self.quantity_to_production,
                 }
-            if self.product.boms:
-                product_bom = self.product.get_bom()
-                production_values.update({'bom': product_bom.bom})
-                if getattr(product_bom, 'route', None):
-                    production_values.update({'route': product_bom.route})
-                if getattr(product_bom, 'routing', None):
-                    production_values.update({'routing': product_bom.routing})
-                if getattr(product_bom, 'process', None):
-                    production_values.update({'process': product_bom.process})
+            production_values.update(
+                self._get_bom_production_values(
+                    self.product, pattern=self._get_bom_pattern(
+                        quantity=Uom.compute_qty(
+                            self.unit, self.quantity_to_production,
+                            self.product.default_uom, round=False))))
             productions_values = [production_values]
+        return productions_values
 
-        productions = []
-        for production_values in productions_values:
-            production = self.get_production(production_values)
+    def _get_bom_pattern(self, quantity=None):
+        """Return the pattern to select the product BOM that supplies the line
 
-            if production:
-                if getattr(production, 'bom', None):
-                    production.inputs = []
-                    production.outputs = []
-                    production.explode_bom()
-                    production.on_change_bom()
+        The quantity is expressed in the default unit of the product, it is
+        not set for the components."""
+        pattern = {}
+        if self.warehouse:
+            pattern['warehouse'] = self.warehouse.id
+        if quantity is not None:
+            pattern['quantity'] = quantity
+        return pattern
 
-                if getattr(production, 'route', None):
-                    production.operations = []
-                    production.on_change_route()
+    @classmethod
+    def _get_bom_production_values(cls, product, pattern=None):
+        """Return the BOM, route, routing and process to produce the product
 
-                production.save()
-                productions.append(production)
+        The product BOM is the one selected by get_bom for the pattern."""
+        product_bom = product.get_bom(pattern)
+        values = {}
+        if product_bom:
+            for name in ['bom', 'route', 'routing', 'process']:
+                if getattr(product_bom, name, None):
+                    values[name] = getattr(product_bom, name)
+        return values
+
+    def compute_productions(self, productions_values=None, explode=True):
+        """Return the unsaved productions that supply the line
 
+        The productions are exploded unless explode is unset because the
+        caller explodes them once merged or moved. All the productions that
+        supply the line, its components included, are computed by this method.
+        The caller must check that the line has no production yet."""
+        if productions_values is None:
+            productions_values = self.get_productions_values()
+        productions = []
+        for production_values in productions_values:
+            with measure('sale_line.get_production', records=1):
+                production = self.get_production(production_values)
+            if production:
+                if explode:
+                    production.explode_supply()
+                productions.append(production)
         return productions
 
+    def get_production_planned_date(self):
+        if hasattr(self, 'manual_delivery_date'):
+            return self.manual_delivery_date
+        return self.shipping_date
+
     def get_production(self, values):
         pool = Pool()
         Production = pool.get('production')
         SaleConfiguration = pool.get('sale.configuration')
+        Location = pool.get('stock.location')
 
         production = Production()
         production.company = self.sale.company
         production.warehouse = self.warehouse
-        production.location = self.warehouse.production_location
+        production.location = Location.get_warehouse_production_location(
+            self.warehouse)
         if hasattr(self, 'cost_plan'):
             production.cost_plan = self.cost_plan
         production.origin = str(self)
+        production.sale_line = self
+        production.sale = self.sale
         production.reference = self.sale.reference
         production.state = 'draft'
         production.product = values['product']
         production.quantity = values['quantity']
         production.unit = values.get('unit', production.product.default_uom)
-        production.planned_date = self.shipping_date
-        if hasattr(self, 'manual_delivery_date'):
-            production.planned_date = self.manual_delivery_date
-        production.set_planned_start_date()
+        production.planned_date = self.get_production_planned_date()
+        with measure('production.set_planned_start_date', records=1):
+            production.set_planned_start_date()
 
-        config = SaleConfiguration(1)
+        config = SaleConfiguration.get_supply_production_values(
+            company=self.sale.company.id)
 
         if (hasattr(Production, 'quality_template') and
                 production.product.template.quality_template):
@@ -168,8 +1236,8 @@ class SaleLine(metaclass=PoolMeta):
 
         if 'routing' in values:
             production.routing = values['routing']
-            if hasattr(config, 'default_work_center') and config.default_work_center:
-                production.work_center = config.default_work_center
+            if config.get('default_work_center'):
+                production.work_center = config['default_work_center']
 
         if 'bom' in values:
             production.bom = values['bom']
@@ -180,26 +1248,113 @@ class SaleLine(metaclass=PoolMeta):
         if default is None:
             default = {}
         default = default.copy()
-        default['productions'] = None
+        default['production_shares'] = None
+        default['production_fingerprint'] = None
         return super(SaleLine, cls).copy(lines, default=default)
 
 
+class SaleLineProduction(ModelSQL, ModelView):
+    "Sale Line - Production"
+    __name__ = 'sale.line-production'
+    sale_line = fields.Many2One(
+        'sale.line', "Sale Line", required=True, ondelete='CASCADE')
+    production = fields.Many2One(
+        'production', "Production", required=True, ondelete='CASCADE')
+    quantity = fields.Float(
+        "Quantity", digits='unit', required=True,
+        help="The quantity of the production allocated to the sale line.")
+    unit = fields.Function(
+        fields.Many2One('product.uom', "Unit"), 'on_change_with_unit')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.sale_line, Index.Range())),
+                Index(t, (t.production, Index.Range())),
+                })
+
+    @fields.depends('production', '_parent_production.unit')
+    def on_change_with_unit(self, name=None):
+        return self.production.unit if self.production else None
+
+
+class SaleQueueTask(ModelSQL):
+    "Sale - Queue Task"
+    __name__ = 'sale.sale-ir.queue'
+    sale = fields.Many2One(
+        'sale.sale', "Sale", required=True, ondelete='CASCADE')
+    task = fields.Many2One(
+        'ir.queue', "Task", required=True, ondelete='CASCADE')
+    type = fields.Selection([
+            ('process', "Process"),
+            ('productions', "Productions"),
+            ], "Type", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.sale, Index.Range()),
+                    (t.type, Index.Equality())),
+                Index(t, (t.task, Index.Range())),
+                })
+
+
+class MaterialRequirements(Wizard):
+    "Sale Material Requirements"
+    __name__ = 'sale.material_requirements'
+    start = StateView('sale.material_requirements.start',
+        'sale_supply_production.material_requirements_start_view_form', [
+            Button("Close", 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        return {
+            'requirements': Sale.get_material_requirements(self.records),
+            }
+
+
+class MaterialRequirementsStart(ModelView):
+    "Sale Material Requirements"
+    __name__ = 'sale.material_requirements.start'
+    requirements = fields.One2Many(
+        'sale.material_requirement', None, "Requirements", readonly=True)
+
+
+class MaterialRequirement(ModelView):
+    "Sale Material Requirement"
+    __name__ = 'sale.material_requirement'
+    warehouse = fields.Many2One(
+        'stock.location', "Warehouse", readonly=True)
+    date = fields.Date("Date", readonly=True)
+    product = fields.Many2One('product.product', "Product", readonly=True)
+    quantity = fields.Float("Quantity", digits='unit', readonly=True)
+    unit = fields.Many2One('product.uom', "Unit", readonly=True)
+
+
 class ChangeLineQuantityStart(metaclass=PoolMeta):
     __name__ = 'sale.change_line_quantity.start'
 
     def on_change_with_minimal_quantity(self):
         pool = Pool()
-        Uom = pool.get('product.uom')
+        SaleLine = pool.get('sale.line')
 
         minimal_quantity = super(ChangeLineQuantityStart,
             self).on_change_with_minimal_quantity()
 
         produced_quantity = 0
-        productions = self.line.productions if self.line else []
-        for production in productions:
-            if production.state in ('assigned', 'running', 'done', 'cancelled'):
-                produced_quantity += Uom.compute_qty(production.unit,
-                    production.quantity, self.line.unit)
+        if self.line and self.line.id is not None and self.line.id >= 0:
+            quantities = SaleLine.get_production_quantities(
+                [self.line])[self.line.id]
+            produced_quantity = sum(
+                q for s, q in quantities.items()
+                if s in ('assigned', 'running', 'done', 'cancelled'))
 
         return max(minimal_quantity, produced_quantity)
 
@@ -215,49 +1370,181 @@ class ChangeLineQuantity(metaclass=PoolMeta):
         return super(ChangeLineQuantity, self).transition_modify()
 
     def update_production(self):
+        with measure('sale.change_line_quantity', records=1):
+            self._update_production()
+
+    def _update_production(self):
+        """Change the supply of the line to its new quantity
+
+        The reused productions keep supplying the line up to the new quantity
+        and their shares are only lowered or deleted. The rest of the quantity
+        is supplied by the productions of the line, which are resized or
+        deleted, or by a new production. The productions of the components
+        are resized or deleted in proportion."""
         pool = Pool()
         Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
         Uom = pool.get('product.uom')
         line = self.start.line
         quantity = self.start.new_quantity
 
-        for production in line.productions:
-            if production.state in ('assigned', 'running', 'done', 'cancelled'):
-                quantity -= Uom.compute_qty(production.unit,
-                    production.quantity, self.start.line.unit)
+        quantities = SaleLine.get_production_quantities([line])[line.id]
+        quantity -= sum(
+            q for s, q in quantities.items()
+            if s in ('assigned', 'running', 'done', 'cancelled'))
         if quantity < 0:
             raise UserError(gettext(
                 'sale_supply_production.quantity_already_produced'))
         updateable_productions = self.get_updateable_productions()
-        if quantity >= line.unit.rounding:
-            production = updateable_productions.pop(0)
-            self._change_production_quantity(
-                production,
-                Uom.compute_qty(line.unit, quantity, production.unit))
-            production.save()
+        updateable_shares = self.get_updateable_shares()
+        if not updateable_productions and not updateable_shares:
+            raise UserError(gettext(
+                'sale_supply_production.no_updateable_productions'))
+        reused_shares = [
+            s for s in updateable_shares if not s.production.sale_shared]
+        updateable_shares = [
+            s for s in updateable_shares if s.production.sale_shared]
+        supplied_quantity = sum(
+            Uom.compute_qty(p.unit, p.quantity, line.unit, round=False)
+            for p in updateable_productions)
+        supplied_quantity += sum(
+            Uom.compute_qty(
+                s.production.unit, s.quantity, line.unit, round=False)
+            for s in updateable_shares)
+
+        for share in reused_shares:
+            share_quantity = Uom.compute_qty(
+                share.production.unit, share.quantity, line.unit, round=False)
+            if line.unit.round(quantity - share_quantity) < 0:
+                self._change_share_quantity(share, quantity)
+                share_quantity = quantity
+            quantity = line.unit.round(quantity - share_quantity)
+
+        if quantity < line.unit.rounding:
+            quantity = 0
+        if supplied_quantity:
+            self._change_components_quantity(quantity / supplied_quantity)
+        if quantity:
+            if updateable_productions:
+                production = updateable_productions.pop(0)
+                self._change_production_quantity(
+                    production,
+                    Uom.compute_qty(line.unit, quantity, production.unit))
+            elif updateable_shares:
+                share = updateable_shares.pop(0)
+                self._change_share_quantity(share, quantity)
+            else:
+                self._create_production(quantity)
         if updateable_productions:
             Production.delete(updateable_productions)
+        for share in updateable_shares:
+            self._change_share_quantity(share, 0)
 
     def _change_production_quantity(self, production, quantity):
-        production.quantity = quantity
-        if getattr(production, 'route', None):
-            production.on_change_route()
-
-        if production.bom:
-            production.inputs = []
-            production.outputs = []
-            production.explode_bom()
+        production.set_quantity(quantity)
         production.save()
 
-    def get_updateable_productions(self):
-        productions = sorted(
-            [p for p in self.start.line.productions
-                if p.state in ('draft', 'waiting')],
-            key=self._production_key)
-        if not productions:
+    def _change_components_quantity(self, factor):
+        "Multiply by factor the quantity of the components of the line"
+        pool = Pool()
+        Production = pool.get('production')
+        line = self.start.line
+
+        productions = [
+            p for p in line.productions
+            if p.state in ('draft', 'waiting')
+            and p.sale_line == line
+            and p.product != line.product]
+        for production in productions:
+            quantity = production.unit.round(production.quantity * factor)
+            if quantity < production.unit.rounding:
+                Production.delete([production])
+            else:
+                self._change_production_quantity(production, quantity)
+        for share in line.production_shares:
+            production = share.production
+            if (production.state in ('draft', 'waiting')
+                    and production.product != line.product):
+                self._change_share_quantity(
+                    share, share.quantity * factor, production.unit)
+
+    def _change_share_quantity(self, share, quantity, unit=None):
+        """Change the quantity of the line supplied by a shared production
+
+        The quantity is expressed in unit, by default the unit of the line.
+        The productions shared by sales are resized, and deleted once they
+        supply no line, but the reused productions are never changed."""
+        pool = Pool()
+        Production = pool.get('production')
+        Share = pool.get('sale.line-production')
+        Uom = pool.get('product.uom')
+        production = share.production
+
+        quantity = Uom.compute_qty(
+            unit or share.sale_line.unit, quantity, production.unit)
+        if production.sale_shared:
+            production_quantity = (
+                production.quantity + quantity - share.quantity)
+            if production_quantity < production.unit.rounding:
+                # The shares are deleted in cascade
+                Production.delete([production])
+                return
+            self._change_production_quantity(production, production_quantity)
+        elif quantity > share.quantity:
+            quantity = share.quantity
+        if quantity:
+            share.quantity = quantity
+            share.save()
+        else:
+            Share.delete([share])
+
+    def _create_production(self, quantity):
+        """Create a production to supply the quantity of the line and the
+        productions of its components"""
+        pool = Pool()
+        Production = pool.get('production')
+        SaleLine = pool.get('sale.line')
+        Share = pool.get('sale.line-production')
+        Configuration = pool.get('sale.configuration')
+        Uom = pool.get('product.uom')
+        line = self.start.line
+        config = Configuration.get_supply_production_values(
+            company=line.sale.company.id)
+
+        productions_values = line.get_productions_values()
+        if len(productions_values) != 1:
             raise UserError(gettext(
                 'sale_supply_production.no_updateable_productions'))
-        return productions
+        values, = productions_values
+        values = values.copy()
+        values['quantity'] = Uom.compute_qty(
+            line.unit, quantity, values.get('unit', line.unit))
+        productions = line.compute_productions([values])
+        shares = []
+        if config['components']:
+            components, shares = SaleLine._create_component_productions(
+                [(line, p) for p in productions],
+                config['consolidate_days'] or 1)
+            productions.extend(components)
+        Production.save_with_moves(productions)
+        Share.save(shares)
+
+    def get_updateable_productions(self):
+        line = self.start.line
+        return sorted(
+            [p for p in line.productions
+                if p.state in ('draft', 'waiting')
+                and p.sale_line == line
+                and p.product == line.product],
+            key=self._production_key)
+
+    def get_updateable_shares(self):
+        line = self.start.line
+        return sorted(
+            [s for s in line.production_shares
+                if s.production.state in ('draft', 'waiting')
+                and s.production.product == line.product],
+            key=lambda s: -s.quantity)
 
     def _production_key(self, production):
         return -production.quantity
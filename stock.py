@@ -0,0 +1,25 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+
+
+class Location(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+    _production_location_cache = Cache(
+        'stock.location.production_location', context=False)
+
+    @classmethod
+    def get_warehouse_production_location(cls, warehouse):
+        "Return the production location of the warehouse"
+        location_id = cls._production_location_cache.get(warehouse.id, -1)
+        if location_id == -1:
+            location = warehouse.production_location
+            location_id = location.id if location else None
+            cls._production_location_cache.set(warehouse.id, location_id)
+        return cls(location_id) if location_id is not None else None
+
+    @classmethod
+    def on_modification(cls, mode, locations, field_names=None):
+        super().on_modification(mode, locations, field_names=field_names)
+        cls._production_location_cache.clear()
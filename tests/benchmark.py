@@ -0,0 +1,299 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmark the supply of sales with productions
+
+It creates N sales of M lines of products with BOMs of the given depth and
+width (optionally with routings) and reports, as JSON, the time, the number of
+SQL queries and the number of records of each operation:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// python -m \\
+        trytond.modules.sale_supply_production.tests.benchmark \\
+        --sales 10 --lines 50 --depth 2 --width 3 --routing
+
+The database is configured like for the tests so it can run on SQLite or
+PostgreSQL without network access.
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import sys
+import time
+from decimal import Decimal
+
+from trytond import __version__, backend
+from trytond.modules import get_modules
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.sale_supply_production.tools import count_queries
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.transaction import Transaction
+
+
+class Benchmark:
+
+    def __init__(self, options, counter):
+        self.options = options
+        self.counter = counter
+        self.results = {}
+
+    def measure(self, name, func, records):
+        "Run func and store its duration and number of queries"
+        count = self.counter.count
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        self.results[name] = {
+            'seconds': round(duration, 6),
+            'queries': self.counter.count - count,
+            'records': records,
+            }
+
+    def create_products(self):
+        "Create the products to sell with their BOM tree"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Template = pool.get('product.template')
+        BOM = pool.get('production.bom')
+        ProductBom = pool.get('product.product-production.bom')
+        options = self.options
+
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        category, = Category.create([{
+                    'name': 'Account Category',
+                    'accounting': True,
+                    'account_revenue': revenue.id,
+                    'account_expense': expense.id,
+                    }])
+
+        def create_level(name, count, producible):
+            templates = Template.create([{
+                        'name': '%s %s' % (name, i),
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'producible': producible,
+                        'salable': name == 'product',
+                        'sale_uom': unit.id,
+                        'list_price': Decimal(10),
+                        'supply_production_on_sale': producible,
+                        'account_category': category.id,
+                        'products': [('create', [{}])],
+                        } for i in range(count)])
+            return [t.products[0] for t in templates]
+
+        routing = None
+        if options.routing:
+            Operation = pool.get('production.routing.operation')
+            Routing = pool.get('production.routing')
+            operation, = Operation.create([{'name': 'Operation'}])
+            routing, = Routing.create([{
+                        'name': 'Routing',
+                        'steps': [('create', [{
+                                        'operation': operation.id,
+                                        } for _ in range(options.steps)])],
+                        }])
+
+        products = create_level('product', options.products, True)
+        level = products
+        for depth in range(options.depth):
+            producible = depth < options.depth - 1
+            components = create_level(
+                'component %s' % depth, options.width, producible)
+            boms = BOM.create([{
+                        'name': product.rec_name,
+                        'inputs': [('create', [{
+                                        'product': c.id,
+                                        'unit': unit.id,
+                                        'quantity': 2,
+                                        } for c in components])],
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'unit': unit.id,
+                                        'quantity': 1,
+                                        }])],
+                        } for product in level])
+            product_boms = []
+            for product, bom in zip(level, boms):
+                values = {
+                    'product': product.id,
+                    'bom': bom.id,
+                    }
+                if routing:
+                    routing.boms += (bom,)
+                    values['routing'] = routing.id
+                product_boms.append(values)
+            if routing:
+                routing.save()
+            ProductBom.create(product_boms)
+            level = components
+        return products
+
+    def create_sales(self, products):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        options = self.options
+
+        customer, = Party.create([{
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        sales = []
+        for i in range(options.sales):
+            sale = Sale(
+                party=customer,
+                invoice_method='manual',
+                shipment_method='manual')
+            sale.on_change_party()
+            lines = []
+            for j in range(options.lines):
+                product = products[(i * options.lines + j) % len(products)]
+                lines.append(SaleLine(
+                        type='line',
+                        product=product,
+                        unit=product.sale_uom,
+                        quantity=1 + j % 5,
+                        unit_price=Decimal(10),
+                        supply_production=True,
+                        ))
+            sale.lines = lines
+            sales.append(sale)
+        Sale.save(sales)
+        Sale.quote(sales)
+        return sales
+
+    def update_productions(self, sales):
+        "Increase by one the quantity of the first line of each sale"
+        pool = Pool()
+        ChangeLineQuantity = pool.get(
+            'sale.change_line_quantity', type='wizard')
+        for sale in sales:
+            line = sale.lines[0]
+            session_id, _, _ = ChangeLineQuantity.create()
+            wizard = ChangeLineQuantity(session_id)
+            wizard.start.sale = sale
+            wizard.start.line = line
+            wizard.start.current_quantity = line.quantity
+            wizard.start.new_quantity = line.quantity + 1
+            wizard.start.unit = line.unit
+            wizard.update_production()
+
+    def run(self):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Sale = pool.get('sale.sale')
+        Production = pool.get('production')
+        options = self.options
+
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        if not warehouse.production_location:
+            warehouse.production_location, = Location.search(
+                [('type', '=', 'production')], limit=1)
+            warehouse.save()
+
+        if options.routing:
+            Configuration = pool.get('sale.configuration')
+            WorkCenter = pool.get('production.work.center')
+            work_center, = WorkCenter.create([{
+                        'name': 'Work Center',
+                        'company': Transaction().context['company'],
+                        'warehouse': warehouse.id,
+                        }])
+            configuration = Configuration(1)
+            configuration.default_work_center = work_center
+            configuration.save()
+
+        products = self.create_products()
+        sales = self.create_sales(products)
+        lines = options.sales * options.lines
+
+        self.measure('confirm', lambda: Sale.confirm(sales), lines)
+        sales = Sale.browse(sales)
+        self.measure('process', lambda: Sale.process(sales), lines)
+        sales = Sale.browse(sales)
+        self.measure('process_again', lambda: Sale.process(sales), lines)
+        sales = Sale.browse(sales)
+        try:
+            pool.get('sale.change_line_quantity', type='wizard')
+        except KeyError:
+            pass
+        else:
+            self.measure(
+                'update_production', lambda: self.update_productions(sales),
+                len(sales))
+        productions = Production.search([
+                ('sale', 'in', [s.id for s in sales]),
+                ])
+        self.measure(
+            'delete', lambda: Production.delete(productions), len(productions))
+        return self.results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the supply of sales with productions")
+    parser.add_argument('--sales', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=20,
+        help="the number of lines per sale")
+    parser.add_argument('--products', type=int, default=5,
+        help="the number of distinct products sold")
+    parser.add_argument('--depth', type=int, default=1,
+        help="the number of levels of the BOM tree")
+    parser.add_argument('--width', type=int, default=2,
+        help="the number of inputs of each BOM")
+    parser.add_argument('--routing', action='store_true',
+        help="add a routing to the BOMs")
+    parser.add_argument('--steps', type=int, default=3,
+        help="the number of steps of the routing")
+    parser.add_argument('--output', '-o', type=argparse.FileType('w'),
+        default=sys.stdout)
+    options = parser.parse_args(args)
+
+    modules = ['sale_supply_production', 'production_work']
+    if options.routing:
+        modules.append('production_routing')
+    if 'sale_change_quantity' in get_modules():
+        modules.append('sale_change_quantity')
+
+    # The queries are counted but not written to the log
+    backend_logger = logging.getLogger('trytond.backend')
+    backend_logger.setLevel(logging.DEBUG)
+    backend_logger.propagate = False
+    with count_queries() as counter:
+        activate_module(modules)
+
+        @with_transaction()
+        def benchmark():
+            company = create_company()
+            with set_company(company):
+                create_chart(company)
+                return Benchmark(options, counter).run()
+
+        results = benchmark()
+    json.dump({
+            'date': dt.datetime.now().isoformat(),
+            'trytond': __version__,
+            'backend': backend.name,
+            'parameters': {
+                k: v for k, v in vars(options).items() if k != 'output'},
+            'results': results,
+            }, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,99 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest.mock import PropertyMock, patch
+
+from sql import Null
+
+from trytond import config
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.production.production import (
+    Production as StandardProduction)
+from trytond.modules.sale_supply_production.tools import count_queries
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_product(name="Product", uom=None, producible=True):
+    "Create a salable product in the unit by default"
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+
+    if uom is None:
+        uom, = Uom.search([('name', '=', "Unit")])
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'default_uom': uom.id,
+                'producible': producible,
+                'salable': True,
+                'sale_uom': uom.id,
+                'list_price': Decimal(10),
+                }])
+    product, = Product.create([{'template': template.id}])
+    return product
+
+
+def create_sale(lines, **values):
+    "Create a sale of the product and quantity lines supplied by production"
+    pool = Pool()
+    Party = pool.get('party.party')
+    Sale = pool.get('sale.sale')
+
+    party, = Party.create([{'name': "Customer"}])
+    sale, = Sale.create([{
+                'party': party.id,
+                'lines': [('create', [{
+                                'product': product.id,
+                                'quantity': quantity,
+                                'unit': product.default_uom.id,
+                                'unit_price': Decimal(10),
+                                'supply_production': True,
+                                } for product, quantity in lines])],
+                **values,
+                }])
+    return sale
+
+
+def create_productions(product, quantities, **values):
+    "Create the draft productions of the product in the warehouse"
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Production = pool.get('production')
+
+    warehouse, = Location.search([('code', '=', 'WH')])
+    return Production.create([{
+                'product': product.id,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'warehouse': warehouse.id,
+                'location': warehouse.production_location.id,
+                **values,
+                } for quantity in quantities])
+
+
+@contextmanager
+def set_config(option, value):
+    "Set the option of the sale_supply_production section in the context"
+    section = 'sale_supply_production'
+    if not config.has_section(section):
+        config.add_section(section)
+    previous = config.get(section, option, default='0')
+    config.set(section, option, value)
+    try:
+        yield
+    finally:
+        config.set(section, option, previous)
 
 
 class SaleSupplyProductionTestCase(CompanyTestMixin, ModuleTestCase):
@@ -11,5 +101,578 @@ class SaleSupplyProductionTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'sale_supply_production'
     extras = ['sale_change_quantity', 'production_work']
 
+    @with_transaction()
+    def test_explode_bom(self):
+        "Test explode_bom gives the moves of the standard explosion"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        BOM = pool.get('production.bom')
+        Production = pool.get('production')
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        meter, = Uom.search([('name', '=', "Meter")])
+        centimeter, = Uom.search([('name', '=', "Centimeter")])
+
+        product = create_product("Product")
+        component = create_product("Component", meter, producible=False)
+        phantom_component1 = create_product(
+            "Phantom Component 1", producible=False)
+        phantom_component2 = create_product(
+            "Phantom Component 2", meter, producible=False)
+
+        company = create_company()
+        with set_company(company):
+            phantom, = BOM.create([{
+                        'name': "Phantom",
+                        'phantom': True,
+                        'phantom_unit': unit.id,
+                        'phantom_quantity': 2,
+                        'inputs': [('create', [{
+                                        'product': phantom_component1.id,
+                                        'unit': unit.id,
+                                        'quantity': 3,
+                                        }, {
+                                        'product': phantom_component2.id,
+                                        'unit': centimeter.id,
+                                        'quantity': 35,
+                                        }])],
+                        }])
+            bom, = BOM.create([{
+                        'name': "Product",
+                        'inputs': [('create', [{
+                                        'product': component.id,
+                                        'unit': centimeter.id,
+                                        'quantity': 150,
+                                        }, {
+                                        'phantom_bom': phantom.id,
+                                        'unit': unit.id,
+                                        'quantity': 1,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'unit': unit.id,
+                                        'quantity': 2,
+                                        }])],
+                        }])
+
+            for quantity in [1, 3, 7]:
+                production = Production(
+                    type='assembly', product=product, bom=bom,
+                    unit=unit, quantity=quantity)
+                production.explode_bom()
+                standard = Production(
+                    type='assembly', product=product, bom=bom,
+                    unit=unit, quantity=quantity)
+                StandardProduction.explode_bom(standard)
+
+                def moves(moves):
+                    return sorted(
+                        (m.product.id, m.unit.id, m.quantity) for m in moves)
+                for name in ['inputs', 'outputs']:
+                    with self.subTest(quantity=quantity, name=name):
+                        self.assertEqual(
+                            moves(getattr(production, name)),
+                            moves(getattr(standard, name)))
+                        self.assertTrue(getattr(production, name))
+
+    @with_transaction()
+    def test_rescale(self):
+        "Test rescaling the moves computes them from the BOM"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        BOMInput = pool.get('production.bom.input')
+        Location = pool.get('stock.location')
+        Production = pool.get('production')
+
+        warehouse, = Location.search([('code', '=', 'WH')])
+        product = create_product("Product")
+        component1 = create_product("Component 1", producible=False)
+        component2 = create_product("Component 2", producible=False)
+        unit = product.default_uom
+
+        company = create_company()
+        with set_company(company):
+            bom, = BOM.create([{
+                        'name': "Product",
+                        'inputs': [('create', [{
+                                        'product': component1.id,
+                                        'unit': unit.id,
+                                        'quantity': 3,
+                                        }, {
+                                        'product': component2.id,
+                                        'unit': unit.id,
+                                        'quantity': 10,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'unit': unit.id,
+                                        'quantity': 10,
+                                        }])],
+                        }])
+            production = Production(
+                type='assembly', company=company, warehouse=warehouse,
+                location=warehouse.production_location, product=product,
+                bom=bom, unit=unit, quantity=4)
+            production.explode_bom()
+            production.save()
+
+            def inputs(production):
+                return sorted(
+                    (m.product.id, m.quantity) for m in production.inputs)
+
+            for quantity, quantities in [(1, [1, 1]), (4, [2, 4])]:
+                with self.subTest(quantity=quantity):
+                    production.set_quantity(quantity)
+                    production.save()
+                    production = Production(production.id)
+                    self.assertEqual(
+                        inputs(production),
+                        list(zip([component1.id, component2.id], quantities)))
+                    output, = production.outputs
+                    self.assertEqual(output.quantity, quantity)
+
+            input2, = [i for i in bom.inputs if i.product == component2]
+            BOMInput.delete([input2])
+            production.set_quantity(2)
+            production.save()
+            production = Production(production.id)
+            self.assertEqual(inputs(production), [(component1.id, 1)])
+
+    def test_count_queries(self):
+        "Test counting the queries of the thread keeps the backend logger"
+        logger = logging.getLogger('trytond.backend')
+        level, propagate = logger.level, logger.propagate
+        logger.setLevel(logging.DEBUG)
+        try:
+            with count_queries() as counter:
+                with count_queries():
+                    count = counter.count
+                    logging.getLogger('trytond.backend.test').debug("query")
+                    thread = threading.Thread(
+                        target=logger.debug, args=("query",))
+                    thread.start()
+                    thread.join()
+                self.assertEqual(counter.count, count + 1)
+                self.assertTrue(counter.counting)
+                self.assertEqual(logger.propagate, propagate)
+            self.assertFalse(counter.counting)
+            self.assertEqual(logger.level, logging.DEBUG)
+        finally:
+            logger.setLevel(level)
+
+    @with_transaction()
+    def test_pending_production_tasks(self):
+        "Test sales with failed production tasks are queued again"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Sale = pool.get('sale.sale')
+        SaleTask = pool.get('sale.sale-ir.queue')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.sale_supply_production_queue = True
+            configuration.save()
+            sale = create_sale([(create_product(), 2)])
+
+            def get_tasks():
+                return [t.task for t in SaleTask.search([
+                            ('sale', '=', sale.id),
+                            ('type', '=', 'productions'),
+                            ])]
+
+            Sale._queue_productions([sale])
+            self.assertEqual(len(get_tasks()), 1)
+            self.assertEqual(Sale(sale.id).pending_production_tasks, 1)
+
+            Sale._queue_productions([sale])
+            self.assertEqual(len(get_tasks()), 1)
+
+            # A failed task stays dequeued without being finished
+            Queue.write(get_tasks(), {
+                    'dequeued_at': datetime.datetime.now(),
+                    })
+            self.assertEqual(Sale(sale.id).pending_production_tasks, 0)
+
+            Sale._queue_productions([sale])
+            self.assertEqual(len(get_tasks()), 2)
+            self.assertEqual(Sale(sale.id).pending_production_tasks, 1)
+
+    @with_transaction()
+    def test_queue_process_merge(self):
+        "Test the process of sales is merged into the scheduled tasks"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleTask = pool.get('sale.sale-ir.queue')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale([])
+
+            def get_tasks():
+                return [t.task for t in SaleTask.search([
+                            ('sale', '=', sale.id),
+                            ('type', '=', 'process'),
+                            ])]
+
+            with set_config('process_sale_delay', '60'):
+                Sale.queue_process([sale.id])
+                task, = get_tasks()
+
+                Sale.queue_process([sale.id])
+                self.assertEqual(get_tasks(), [task])
+
+                # The task may start before the transaction is committed
+                Queue.write([task], {
+                        'scheduled_at': (
+                            datetime.datetime.now()
+                            + datetime.timedelta(seconds=5)),
+                        })
+                Sale.queue_process([sale.id])
+                self.assertEqual(len(get_tasks()), 2)
+
+    @with_transaction()
+    def test_create_productions_twice(self):
+        "Test processing twice creates the productions once"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale([(create_product(), 2)])
+
+            with patch.object(
+                    SaleLine, 'quantity_to_production',
+                    new_callable=PropertyMock, return_value=0):
+                Sale._create_productions([sale])
+            self.assertEqual(Production.search([]), [])
+
+            Sale._create_productions([sale])
+            production, = Production.search([])
+            self.assertEqual(production.quantity, 2)
+            self.assertEqual(
+                SaleLine.search([('productions', '=', production.id)]),
+                list(sale.lines))
+            self.assertEqual(
+                SaleLine.search([('productions.quantity', '=', 2)]),
+                list(sale.lines))
+            self.assertEqual(SaleLine.search([('productions', '=', None)]), [])
+
+            Sale._create_productions([sale])
+            self.assertEqual(Production.search([]), [production])
+
+    @with_transaction()
+    def test_create_productions_override(self):
+        "Test the overrides of the deprecated create_productions are called"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale([(create_product(), 2)])
+            line, = sale.lines
+
+            with patch.object(
+                    Sale, 'create_productions', autospec=True,
+                    return_value=[]) as create_productions:
+                Sale._create_productions([sale])
+            create_productions.assert_called_once_with(sale)
+            self.assertEqual(Production.search([]), [])
+
+            with patch.object(
+                    SaleLine, 'create_productions', autospec=True,
+                    return_value=[]) as create_productions:
+                Sale._create_productions([sale])
+            create_productions.assert_called_once_with(line)
+            self.assertEqual(Production.search([]), [])
+
+    @with_transaction()
+    def test_material_requirements(self):
+        "Test the material requirements of sales by warehouse and date"
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        ProductBom = pool.get('product.product-production.bom')
+        Location = pool.get('stock.location')
+        Configuration = pool.get('sale.configuration')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        warehouse, = Location.search([('code', '=', 'WH')])
+        product = create_product("Product")
+        subproduct = create_product("Subproduct")
+        component = create_product("Component", producible=False)
+        unit = product.default_uom
+
+        company = create_company()
+        with set_company(company):
+            bom, subbom = BOM.create([{
+                        'name': "Product",
+                        'inputs': [('create', [{
+                                        'product': subproduct.id,
+                                        'unit': unit.id,
+                                        'quantity': 2,
+                                        }, {
+                                        'product': component.id,
+                                        'unit': unit.id,
+                                        'quantity': 1,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'unit': unit.id,
+                                        'quantity': 1,
+                                        }])],
+                        }, {
+                        'name': "Subproduct",
+                        'inputs': [('create', [{
+                                        'product': component.id,
+                                        'unit': unit.id,
+                                        'quantity': 3,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': subproduct.id,
+                                        'unit': unit.id,
+                                        'quantity': 1,
+                                        }])],
+                        }])
+            ProductBom.create([{
+                        'product': product.id,
+                        'bom': bom.id,
+                        }, {
+                        'product': subproduct.id,
+                        'bom': subbom.id,
+                        }])
+            configuration = Configuration(1)
+            configuration.sale_supply_production_components = True
+            configuration.save()
+
+            sale1 = create_sale(
+                [(product, 1), (product, 2), (product, 1)],
+                warehouse=warehouse.id)
+            sale2 = create_sale([(product, 1)], warehouse=None)
+            today = datetime.date.today()
+            tomorrow = today + datetime.timedelta(days=1)
+            line2date = {
+                sale1.lines[0].id: today,
+                sale1.lines[1].id: today,
+                sale1.lines[2].id: tomorrow,
+                sale2.lines[0].id: today,
+                }
+
+            with patch.object(
+                    SaleLine, 'get_production_planned_date', autospec=True,
+                    side_effect=lambda l: line2date[l.id]):
+                requirements = Sale.get_material_requirements([sale1, sale2])
+            self.assertEqual(
+                sorted((r['warehouse'] or 0, r['date'], r['product'],
+                        r['quantity']) for r in requirements),
+                sorted([
+                        (warehouse.id, today, subproduct.id, 6),
+                        (warehouse.id, today, component.id, 21),
+                        (warehouse.id, tomorrow, subproduct.id, 2),
+                        (warehouse.id, tomorrow, component.id, 7),
+                        (0, today, subproduct.id, 2),
+                        (0, today, component.id, 7),
+                        ]))
+
+    @with_transaction()
+    def test_reuse_productions(self):
+        "Test the sale lines reuse the quantity left of draft productions"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Share = pool.get('sale.line-production')
+        Production = pool.get('production')
+
+        today = datetime.date.today()
+
+        company = create_company()
+        with set_company(company):
+            product = create_product()
+            productions = create_productions(
+                product, [2, 2, 2], planned_date=today)
+            configuration = Configuration(1)
+            configuration.sale_supply_production_reuse = True
+            configuration.save()
+            sale1 = create_sale([(product, 3)])
+            sale2 = create_sale([(product, 4)])
+            line1, = sale1.lines
+            line2, = sale2.lines
+
+            def get_shares(line):
+                return [(s.production, s.quantity) for s in Share.search([
+                            ('sale_line', '=', line.id),
+                            ], order=[('production', 'ASC')])]
+
+            with patch.object(
+                    SaleLine, 'get_production_planned_date',
+                    return_value=today):
+                with patch.object(Production, 'lock') as lock:
+                    Sale._create_productions([sale1])
+                lock.assert_called_once_with(productions[:2])
+                self.assertEqual(
+                    get_shares(line1),
+                    [(productions[0], 2), (productions[1], 1)])
+                self.assertEqual(
+                    Production.search([('sale_line', '=', line1.id)]), [])
+
+                Sale._create_productions([sale2])
+                self.assertEqual(
+                    get_shares(line2),
+                    [(productions[1], 1), (productions[2], 2)])
+                production, = Production.search([
+                        ('sale_line', '=', line2.id),
+                        ])
+                self.assertEqual(production.quantity, 1)
+
+    @with_transaction()
+    def test_planned_start_dates(self):
+        "Test the planned start dates use the lead times loaded at once"
+        pool = Pool()
+        LeadTime = pool.get('production.lead_time')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Production = pool.get('production')
+
+        today = datetime.date.today()
+
+        company = create_company()
+        with set_company(company):
+            products = [create_product("Product %s" % i) for i in range(3)]
+            LeadTime.create([{
+                        'product': product.id,
+                        'lead_time': datetime.timedelta(days=days),
+                        } for product, days in zip(products, [2, 5])])
+            sale = create_sale([(product, 1) for product in products])
+
+            with patch.object(
+                    SaleLine, 'get_production_planned_date',
+                    return_value=today), \
+                    patch.object(
+                        LeadTime, 'search', wraps=LeadTime.search) as search:
+                Sale._create_productions([sale])
+            # The lead times of all the lines are loaded at once
+            search.assert_called_once()
+            for product, days in zip(products, [2, 5, 0]):
+                with self.subTest(product=product.rec_name):
+                    production, = Production.search([
+                            ('product', '=', product.id),
+                            ])
+                    self.assertEqual(production.planned_date, today)
+                    self.assertEqual(
+                        production.planned_start_date,
+                        today - datetime.timedelta(days=days))
+
+    @with_transaction()
+    def test_fill_sale_line_from_origin(self):
+        "Test the migration fills the sale line of productions from origin"
+        pool = Pool()
+        Production = pool.get('production')
+        table = Production.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            product = create_product()
+            sale = create_sale([(product, 1)])
+            line, = sale.lines
+            productions = create_productions(product, [1, 1, 1, 1])
+            cursor.execute(*table.update(
+                    [table.origin, table.sale_line, table.sale],
+                    [str(line), Null, Null],
+                    where=table.id == productions[0].id))
+            # Malformed origins are skipped
+            for production, origin in zip(productions[2:], [
+                        'sale.line,foo', 'sale.line,%s' % (line.id + 1000)]):
+                cursor.execute(*table.update(
+                        [table.origin], [origin],
+                        where=table.id == production.id))
+
+            Production._fill_sale_line_from_origin()
+
+            cursor.execute(*table.select(
+                    table.id, table.sale_line, table.sale,
+                    order_by=[table.id.asc]))
+            self.assertEqual(cursor.fetchall(), [
+                    (productions[0].id, line.id, sale.id),
+                    (productions[1].id, None, None),
+                    (productions[2].id, None, None),
+                    (productions[3].id, None, None),
+                    ])
+
+    @with_transaction()
+    def test_change_quantities_import(self):
+        "Test the import of the file of the change quantities wizard"
+        pool = Pool()
+        Production = pool.get('production')
+        ChangeQuantities = pool.get('production.change_quantities', 'wizard')
+
+        company = create_company()
+        with set_company(company):
+            productions = create_productions(create_product(), [1, 2])
+            Production.set_number(productions)
+
+            session_id, _, _ = ChangeQuantities.create()
+            for data in [
+                    'Number,Quantity\n%s,3\n\n%s,4.5\n',
+                    'Number;Quantity\r\n%s;3\r\n%s;4.5\r\n',
+                    '%s\t3\n%s\t4.5\n',
+                    'Number,\n%s,3\n%s,4.5\n',
+                    '%s,3\n%s,4.5\n%s,3\n',
+                    ]:
+                numbers = [p.number for p in productions] * 2
+                data %= tuple(numbers[:data.count('%s')])
+                with self.subTest(data=data):
+                    change = ChangeQuantities(session_id)
+                    change.start.file = data.encode('utf-8')
+                    self.assertEqual(change.transition_import_(), 'start')
+                    self.assertEqual([
+                            (l.production, l.new_quantity)
+                            for l in change.start.lines],
+                        list(zip(productions, [3, 4.5])))
+
+            for data in [
+                    'Number,Quantity\n%s,3\n%s\n' % (
+                        productions[0].number, productions[1].number),
+                    'Number,Quantity\n%s,3\n%s,x\n' % (
+                        productions[0].number, productions[1].number),
+                    'Number,Quantity\n%s,3\nUnknown,4\n' % (
+                        productions[0].number),
+                    'Number,Quantity\n%s,3\n%s,4\n' % (
+                        productions[0].number, productions[0].number),
+                    ]:
+                with self.subTest(data=data):
+                    change = ChangeQuantities(session_id)
+                    change.start.file = data.encode('utf-8')
+                    with self.assertRaisesRegex(UserError, 'row 3'):
+                        change.transition_import_()
+
+    @with_transaction()
+    def test_create_productions_chunks(self):
+        "Test the lines supplied by chunks are locked once"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            product = create_product()
+            sale = create_sale([(product, q) for q in [1, 2, 3]])
+
+            with set_config('create_productions_chunk_size', '2'), \
+                    patch.object(SaleLine, 'lock') as lock:
+                productions = Sale._create_productions([sale])
+            self.assertEqual(lock.call_count, 1)
+            self.assertEqual(
+                sorted(p.quantity for p in productions), [1, 2, 3])
+            self.assertEqual(len(Production.search([])), 3)
+
 
 del ModuleTestCase
@@ -195,3 +195,213 @@ class Test(unittest.TestCase):
         self.assertEqual(sale_line.quantity, 4.0)
         production, = sale.productions
         self.assertEqual(production.quantity, 4.0)
+        self.assertEqual(
+            sorted([m.quantity for m in production.inputs]), [20.0, 600.0])
+        self.assertEqual(
+            [m.quantity for m in production.outputs], [4.0])
+
+        # Change the quantity of a waiting production::
+        production.click('wait')
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 5.0
+        change.execute('modify')
+        production.reload()
+        self.assertEqual(production.state, 'waiting')
+        self.assertEqual(production.quantity, 5.0)
+        self.assertEqual(
+            sorted([m.quantity for m in production.inputs]), [25.0, 750.0])
+        self.assertEqual(
+            [m.quantity for m in production.outputs], [5.0])
+
+        # The BOM is exploded again when it is modified after the production::
+        input2, = [i for i in bom.inputs if i.product == component2]
+        input2.quantity = 200
+        bom.save()
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 6.0
+        change.execute('modify')
+        production.reload()
+        self.assertEqual(production.quantity, 6.0)
+        self.assertEqual(
+            sorted([m.quantity for m in production.inputs]), [30.0, 1200.0])
+        self.assertEqual(
+            [m.quantity for m in production.outputs], [6.0])
+        Move = Model.get('stock.move')
+        self.assertEqual(
+            len(Move.find([('product', '=', component2.id)])), 1)
+
+        # Change the quantity of a line supplied by a shared production::
+        Configuration = Model.get('sale.configuration')
+        configuration = Configuration(1)
+        configuration.sale_supply_production_consolidate = True
+        configuration.save()
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        for quantity in [2.0, 3.0]:
+            sale_line = SaleLine()
+            sale.lines.append(sale_line)
+            sale_line.product = product
+            sale_line.quantity = quantity
+        sale.click('quote')
+        sale.click('confirm')
+        Production = Model.get('production')
+        shared, = Production.find([('sale_line_shares', '!=', None)])
+        self.assertEqual(shared.quantity, 5.0)
+        self.assertEqual(sale.productions, [shared])
+        sale_line, _ = sale.lines
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 4.0
+        change.execute('modify')
+        shared.reload()
+        self.assertEqual(shared.quantity, 7.0)
+        self.assertEqual(
+            sorted([s.quantity for s in shared.sale_line_shares]), [3.0, 4.0])
+        self.assertEqual(
+            sorted([m.quantity for m in shared.inputs]), [35.0, 1400.0])
+        self.assertEqual(
+            [m.quantity for m in shared.outputs], [7.0])
+
+        # Change the quantity of a line supplied by a reused production::
+        configuration.sale_supply_production_consolidate = False
+        configuration.sale_supply_production_reuse = True
+        configuration.save()
+        stock = Production()
+        stock.product = product
+        stock.bom = bom
+        stock.quantity = 2
+        stock.save()
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        sale_line = SaleLine()
+        sale.lines.append(sale_line)
+        sale_line.product = product
+        sale_line.quantity = 3.0
+        sale.click('quote')
+        sale.click('confirm')
+        sale_line, = sale.lines
+        production, = [p for p in sale.productions if p != stock]
+        self.assertEqual(production.quantity, 1.0)
+        share, = stock.sale_line_shares
+        self.assertEqual(share.quantity, 2.0)
+
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 4.0
+        change.execute('modify')
+        stock.reload()
+        production.reload()
+        self.assertEqual(stock.quantity, 2.0)
+        share, = stock.sale_line_shares
+        self.assertEqual(share.quantity, 2.0)
+        self.assertEqual(production.quantity, 2.0)
+
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 1.0
+        change.execute('modify')
+        stock.reload()
+        self.assertEqual(stock.quantity, 2.0)
+        self.assertEqual(
+            sorted([m.quantity for m in stock.inputs]), [10.0, 400.0])
+        share, = stock.sale_line_shares
+        self.assertEqual(share.quantity, 1.0)
+        self.assertEqual(Production.find([('id', '=', production.id)]), [])
+        sale.reload()
+        self.assertEqual(sale.productions, [stock])
+
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 3.0
+        change.execute('modify')
+        stock.reload()
+        self.assertEqual(stock.quantity, 2.0)
+        share, = stock.sale_line_shares
+        self.assertEqual(share.quantity, 1.0)
+        sale.reload()
+        production, = [p for p in sale.productions if p != stock]
+        self.assertEqual(production.quantity, 2.0)
+        self.assertEqual(production.sale_line, sale_line)
+
+        # Change the quantity of a line with the productions of components::
+        configuration.sale_supply_production_reuse = False
+        configuration.sale_supply_production_components = True
+        configuration.save()
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        sale_line = SaleLine()
+        sale.lines.append(sale_line)
+        sale_line.product = product
+        sale_line.quantity = 2.0
+        sale.click('quote')
+        sale.click('confirm')
+        sale_line, = sale.lines
+        production, = [p for p in sale.productions if p.product == product]
+        self.assertEqual(production.sale_line, sale_line)
+        component, = [p for p in sale.productions if p.product == component1]
+        self.assertEqual(component.quantity, 10.0)
+        self.assertEqual(component.sale_line, None)
+        share, = component.sale_line_shares
+        self.assertEqual(share.sale_line, sale_line)
+        self.assertEqual(share.quantity, 10.0)
+
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 4.0
+        change.execute('modify')
+        production.reload()
+        component.reload()
+        self.assertEqual(production.quantity, 4.0)
+        self.assertEqual(component.quantity, 20.0)
+        self.assertEqual(
+            sorted([m.quantity for m in component.inputs]), [20.0, 20.0])
+        share, = component.sale_line_shares
+        self.assertEqual(share.quantity, 20.0)
+
+        # The productions of the components are merged with other lines::
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        for quantity in [2.0, 3.0]:
+            sale_line = SaleLine()
+            sale.lines.append(sale_line)
+            sale_line.product = product
+            sale_line.quantity = quantity
+        sale.click('quote')
+        sale.click('confirm')
+        component.reload()
+        self.assertEqual(component.quantity, 45.0)
+        self.assertEqual(
+            sorted([s.quantity for s in component.sale_line_shares]),
+            [10.0, 15.0, 20.0])
+        sale_line, _ = sale.lines
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 4.0
+        change.execute('modify')
+        component.reload()
+        self.assertEqual(component.quantity, 55.0)
+        self.assertEqual(
+            sorted([m.quantity for m in component.inputs]), [55.0, 55.0])
+        self.assertEqual(
+            sorted([s.quantity for s in component.sale_line_shares]),
+            [15.0, 20.0, 20.0])
+
+        change = Wizard('sale.change_line_quantity', [sale])
+        change.form.line = sale_line
+        change.form.new_quantity = 1.0
+        change.execute('modify')
+        component.reload()
+        self.assertEqual(component.quantity, 40.0)
+        self.assertEqual(
+            sorted([s.quantity for s in component.sale_line_shares]),
+            [5.0, 15.0, 20.0])
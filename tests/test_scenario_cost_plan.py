@@ -0,0 +1,110 @@
+from trytond.tests.tools import activate_modules
+from trytond.modules.account_invoice.tests.tools import set_fiscalyear_invoice_sequences, create_payment_term
+from trytond.modules.account.tests.tools import create_fiscalyear, create_chart, get_accounts
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.exceptions import UserWarning
+from proteus import Model
+from decimal import Decimal
+import unittest
+from trytond.tests.test_tryton import drop_db
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+        activate_modules(['sale_supply_production', 'sale_cost_plan'])
+
+        # Create company::
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year::
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts::
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        revenue = accounts['revenue']
+        expense = accounts['expense']
+
+        # Create parties::
+        Party = Model.get('party.party')
+        customer = Party(name='Customer')
+        customer.save()
+
+        # Create payment term::
+        payment_term = create_payment_term()
+        payment_term.save()
+
+        # Create account category::
+        ProductCategory = Model.get('product.category')
+        account_category = ProductCategory(name="Account Category")
+        account_category.accounting = True
+        account_category.account_expense = expense
+        account_category.account_revenue = revenue
+        account_category.save()
+
+        # Create products::
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+
+        def create_product(name, producible):
+            template = ProductTemplate()
+            template.name = name
+            template.default_uom = unit
+            template.type = 'goods'
+            template.producible = producible
+            template.salable = True
+            template.list_price = Decimal(30)
+            template.account_category = account_category
+            template.save()
+            product, = template.products
+            return product
+
+        product = create_product('product', True)
+        goods = create_product('goods', False)
+
+        # Create cost plan::
+        CostPlan = Model.get('product.cost.plan')
+        cost_plan = CostPlan()
+        cost_plan.product = product
+        cost_plan.quantity = 1
+        cost_plan.save()
+
+        # Sale products::
+        Sale = Model.get('sale.sale')
+        SaleLine = Model.get('sale.line')
+
+        def create_sale(product, cost_plan):
+            sale = Sale()
+            sale.party = customer
+            sale.payment_term = payment_term
+            sale.invoice_method = 'order'
+            sale_line = SaleLine()
+            sale.lines.append(sale_line)
+            sale_line.product = product
+            sale_line.quantity = 1
+            sale_line.supply_production = False
+            sale_line.cost_plan = cost_plan
+            sale.click('quote')
+            return sale
+
+        # The sales with a producible line without cost plan are warned::
+        sale = create_sale(product, None)
+        with self.assertRaises(UserWarning):
+            sale.click('confirm')
+
+        # The sales with cost plans or without producible lines are not::
+        for sale in [create_sale(product, cost_plan), create_sale(goods, None)]:
+            sale.click('confirm')
+            self.assertEqual(sale.state, 'processing')
@@ -1,6 +1,16 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-__all__ = ['prepare_vals']
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+import trytond.config as config
+
+__all__ = ['prepare_vals', 'count_queries', 'measure', 'stats']
+
+logger = logging.getLogger(__name__)
 
 
 def prepare_vals(values, to_write=False):
@@ -29,3 +39,120 @@ def prepare_vals(values, to_write=False):
     elif isinstance(values, list):
         return [prepare_vals(v) for v in values]
     return values
+
+
+class QueryCounter(logging.Handler):
+    """Count the queries logged by the database backend in the threads that
+    are counting
+
+    The records are only counted, they are still handled by the other handlers
+    of the loggers."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self._local = threading.local()
+
+    def emit(self, record):
+        if record.levelno <= logging.DEBUG and self.counting:
+            self._local.count = self.count + 1
+
+    @property
+    def counting(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    @contextmanager
+    def counter(self):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+
+
+_query_counter = QueryCounter()
+
+
+@contextmanager
+def count_queries():
+    """Yield the counter of the queries logged by the database backend in the
+    current thread
+
+    The configuration of the trytond.backend logger is not changed so the
+    queries are counted only when its debug level is enabled by the logging
+    configuration. The SQLite backend logs only the queries of the connections
+    opened with the debug level enabled."""
+    # addHandler does not add the same handler twice
+    logging.getLogger('trytond.backend').addHandler(_query_counter)
+    with _query_counter.counter() as counter:
+        yield counter
+
+
+class Stats:
+    "Registry of the calls, duration, queries and records of each stage"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._stages = defaultdict(lambda: {
+                    'calls': 0,
+                    'seconds': 0.0,
+                    'queries': 0,
+                    'records': 0,
+                    })
+
+    def add(self, stage, seconds, queries, records):
+        with self._lock:
+            values = self._stages[stage]
+            values['calls'] += 1
+            values['seconds'] += seconds
+            values['queries'] += queries or 0
+            values['records'] += records
+
+    def get(self):
+        with self._lock:
+            return {k: v.copy() for k, v in self._stages.items()}
+
+
+stats = Stats()
+
+
+@contextmanager
+def measure(stage, records=0):
+    """Measure the duration, the number of queries and of records of stage
+
+    It is enabled by the instrumentation option of the sale_supply_production
+    section of the configuration and the queries are counted only when
+    instrumentation_queries is also set and the debug level of the
+    trytond.backend logger is enabled. The measures are logged at the debug
+    level and added to stats. The stages can be nested."""
+    if not config.getboolean(
+            'sale_supply_production', 'instrumentation', default=False):
+        yield
+        return
+    with ExitStack() as stack:
+        counter = None
+        if (config.getboolean(
+                    'sale_supply_production', 'instrumentation_queries',
+                    default=False)
+                and logging.getLogger('trytond.backend').isEnabledFor(
+                    logging.DEBUG)):
+            counter = stack.enter_context(count_queries())
+        queries = counter.count if counter else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if counter:
+                queries = counter.count - queries
+            stats.add(stage, seconds, queries, records)
+            logger.debug(
+                "%s: %.6fs, %s queries, %s records",
+                stage, seconds, queries, records)
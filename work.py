@@ -0,0 +1,113 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from collections import Counter, defaultdict
+
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+
+from trytond.model import Index
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+
+class Production(metaclass=PoolMeta):
+    __name__ = 'production'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.work_center, Index.Range()),
+                (Coalesce(t.planned_start_date, t.planned_date),
+                    Index.Range()),
+                where=t.state.in_(sorted(cls._work_center_load_states()))))
+
+    @classmethod
+    def _work_center_load_states(cls):
+        return {'request', 'draft', 'waiting', 'assigned', 'running'}
+
+    @classmethod
+    def get_work_center_loads(cls, work_centers, start=None, end=None):
+        """Return the load of the work centers by date between start and end
+
+        The load is the number of open productions planned to start on the
+        date. It is counted with one indexed query, so concurrent transactions
+        do not update any shared row. The loads without date are returned only
+        when there is no start nor end."""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        loads = defaultdict(Counter)
+        date = Coalesce(table.planned_start_date, table.planned_date)
+        for sub_work_centers in grouped_slice(work_centers):
+            where = (reduce_ids(
+                    table.work_center, [w.id for w in sub_work_centers])
+                & table.state.in_(list(cls._work_center_load_states())))
+            if start:
+                where &= date >= start
+            if end:
+                where &= date <= end
+            cursor.execute(*table.select(
+                    table.work_center, date, Count(table.id),
+                    where=where,
+                    group_by=[table.work_center, date]))
+            for work_center, date_, load in cursor:
+                if isinstance(date_, str):
+                    date_ = datetime.date.fromisoformat(date_)
+                loads[work_center][date_] += load
+        return loads
+
+    @classmethod
+    def assign_work_centers(cls, productions):
+        """Assign to the new productions of a work center with children the
+        child of the same warehouse with the least load in their planned dates
+
+        The loads are read with one query and updated as the productions are
+        assigned."""
+        to_assign = [
+            p for p in productions
+            if (p.id is None or p.id < 0)
+            and getattr(p, 'work_center', None) and p.work_center.children]
+        if not to_assign:
+            return
+
+        work_centers = {c for p in to_assign for c in p.work_center.children}
+        start = end = None
+        if all(p.planned_start_date or p.planned_date for p in to_assign):
+            start = min(
+                p.planned_start_date or p.planned_date for p in to_assign)
+            end = max(
+                p.planned_date or p.planned_start_date for p in to_assign)
+        loads = cls.get_work_center_loads(list(work_centers), start, end)
+
+        for production in to_assign:
+            candidates = [
+                c for c in production.work_center.children
+                if c.warehouse == production.warehouse]
+            if not candidates:
+                continue
+            start = production.planned_start_date or production.planned_date
+            end = production.planned_date or start
+
+            def get_load(work_center):
+                return sum(
+                    l for d, l in loads[work_center.id].items()
+                    if not start or (d and start <= d <= end))
+            work_center = min(candidates, key=get_load)
+            production.work_center = work_center
+            loads[work_center.id][start] += 1
+
+
+class WorkCenter(metaclass=PoolMeta):
+    __name__ = 'production.work.center'
+
+    @classmethod
+    def on_modification(cls, mode, work_centers, field_names=None):
+        pool = Pool()
+        Production = pool.get('production')
+        super().on_modification(mode, work_centers, field_names=field_names)
+        Production._route_operations_cache.clear()